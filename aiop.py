@@ -0,0 +1,459 @@
+import asyncio, functools, io, json, logging, math, time, typing, aiohttp, telebot
+from telebot.async_telebot import AsyncTeleBot
+from config import (
+    IAM_TOKEN_ENDPOINT,
+    HTTP_TIMEOUT,
+    HTTP_RETRIES,
+    HTTP_BACKOFF_FACTOR,
+    ASYNC_HTTP_LIMIT,
+    ASYNC_HTTP_LIMIT_PER_HOST,
+    GPT_CONTEXT_BUDGET,
+    GPT_CONTEXT_KEEP,
+    GPT_SUMMARIZE,
+    GPT_SUMMARY_TOKENS,
+    STT_SEGMENT_DURATION,
+    STT_STREAM_CHUNK,
+)
+from iop import IOP, SpeechKit, GPT, HTTPClient, IAMToken, OggOpus, iam_manager, audio_cache, usage_counter
+
+
+class AsyncHTTPClient:
+    """
+    Shared aiohttp session for Yandex Cloud calls.
+
+    The async counterpart of HTTPClient: keep-alive connections limited per host,
+    the same timeouts and retries with exponential backoff on 429/5xx.
+    """
+
+    def __init__(self):
+        self.session: aiohttp.ClientSession | None = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=ASYNC_HTTP_LIMIT, limit_per_host=ASYNC_HTTP_LIMIT_PER_HOST
+                ),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=HTTP_TIMEOUT[0], sock_read=HTTP_TIMEOUT[1]
+                ),
+            )
+        return self.session
+
+    async def request(self, method: str, url: str, **kwargs) -> tuple[int, bytes]:
+        """
+        Sends a request, retrying failed connections and retryable statuses.
+
+        Returns:
+            tuple[int, bytes]: The status code and the body of the last response.
+        """
+        session = self.get_session()
+        for attempt in range(HTTP_RETRIES + 1):
+            try:
+                async with session.request(method, url, **kwargs) as response:
+                    status, body = response.status, await response.read()
+            except aiohttp.ClientConnectorError:
+                # Only a failed connection is retried: after a read timeout or a
+                # dropped connection the request may have been processed (and billed).
+                if attempt == HTTP_RETRIES:
+                    raise
+            else:
+                if status not in HTTPClient.RETRY_STATUSES or attempt == HTTP_RETRIES:
+                    return status, body
+            await asyncio.sleep(HTTP_BACKOFF_FACTOR * 2**attempt)
+
+    async def get(self, url: str, **kwargs) -> tuple[int, bytes]:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> tuple[int, bytes]:
+        return await self.request("POST", url, **kwargs)
+
+    async def upload(self, url: str, data: typing.AsyncIterable[bytes], **kwargs) -> tuple[int, bytes]:
+        """
+        Posts a body produced by an async iterator with chunked transfer encoding.
+
+        A streamed body can be sent only once, so the request is not retried.
+        """
+        async with self.get_session().post(url, data=data, **kwargs) as response:
+            return response.status, await response.read()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+async_http_client = AsyncHTTPClient()
+
+
+async def run_blocking(func: typing.Callable, *args, **kwargs):
+    """
+    Runs a blocking call (SQLite, disk, CPU-bound parsing) in the default executor,
+    so it does not stall the event loop.
+
+    Returns:
+        The result of func(*args, **kwargs).
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+class AsyncIOP(IOP):
+    """
+    Async variant of IOP.
+
+    Shares the in-memory IAM token with the synchronous classes; an expired token
+    is refreshed without blocking the event loop.
+    """
+
+    token_lock: asyncio.Lock | None = None
+
+    @classmethod
+    def get_token_lock(cls) -> asyncio.Lock:
+        """
+        Creates the lock on first use, inside the running event loop: before Python 3.10
+        a lock created at import time is bound to a different loop.
+        """
+        if AsyncIOP.token_lock is None:
+            AsyncIOP.token_lock = asyncio.Lock()
+        return AsyncIOP.token_lock
+
+    async def get_iam_token(self) -> str:
+        """
+        Retrieves the IAM token for authentication.
+
+        Returns:
+            str: The IAM token.
+        """
+        if iam_manager.refresher is None:
+            await run_blocking(iam_manager.start)
+        if iam_manager.expires_at <= time.time():
+            async with self.get_token_lock():
+                if iam_manager.expires_at <= time.time():
+                    await self.create_new_iam_token()
+        return iam_manager.access_token
+
+    async def create_new_iam_token(self):
+        """
+        Creates a new IAM token.
+        """
+        headers = {"Metadata-Flavor": "Google"}
+
+        try:
+            status, body = await async_http_client.get(IAM_TOKEN_ENDPOINT, headers=headers)
+
+        except Exception as e:
+            logging.error(f"Не удалось выполнить запрос (AsyncIOP.create_new_iam_token): {e}")
+            logging.info("Токен не получен (AsyncIOP.create_new_iam_token)")
+
+        else:
+            if status == 200:
+                await run_blocking(iam_manager.update, IAMToken.parse(json.loads(body)))
+            else:
+                logging.error(
+                    f"Ошибка при получении ответа (AsyncIOP.create_new_iam_token): {status}"
+                )
+                logging.info("Токен не получен (AsyncIOP.create_new_iam_token)")
+
+
+class AsyncSpeechKit(AsyncIOP, SpeechKit):
+
+    async def text_to_speech(self, text: str, id: int) -> tuple[bool, bytes | str]:
+        """
+        Converts the given text to speech using the Yandex SpeechKit API.
+
+        Args:
+            text (str): The text to be converted to speech.
+            id (int): The ID used to retrieve voice, emotion, and speed settings from the database.
+
+        Returns:
+            tuple: The same as SpeechKit.text_to_speech.
+        """
+        iam_token = await self.get_iam_token()
+
+        headers = {
+            "Authorization": f"Bearer {iam_token}",
+        }
+        status, content = await async_http_client.post(
+            self.TTS_URL,
+            headers=headers,
+            data=await run_blocking(self.synthesis_data, text, id),
+        )
+
+        if status == 200:
+            return True, content
+        else:
+            logging.error(
+                f"Ошибка в запросе (AsyncSpeechKit.text_to_speech): {content}"
+            )
+            return (
+                False,
+                f"При запросе в SpeechKit возникла ошибка c кодом: {status}",
+            )
+
+    async def speech_to_text(self, file: bytes | typing.AsyncIterable[bytes], id: str) -> tuple[bool, str]:
+        """
+        Converts speech to text using the Yandex SpeechKit API.
+
+        Args:
+            file (bytes | AsyncIterable[bytes]): The audio file to be converted, or its
+                chunks, which are uploaded as they are produced (without retries).
+            id (str): The ID associated with the audio file.
+
+        Returns:
+            tuple: The same as SpeechKit.speech_to_text.
+        """
+        iam_token = await self.get_iam_token()
+
+        headers = {
+            "Authorization": f"Bearer {iam_token}",
+        }
+
+        post = async_http_client.post if isinstance(file, bytes) else async_http_client.upload
+        status, body = await post(
+            f"{self.STT_URL}?{self.recognition_params()}",
+            headers=headers,
+            data=file,
+        )
+
+        decoded_data = json.loads(body)
+        if decoded_data.get("error_code") is None:
+            return (True, decoded_data.get("result"))
+        else:
+            logging.error(
+                f'Ошибка в запросе (AsyncSpeechKit.speech_to_text): {decoded_data.get("error_code")}'
+            )
+            return (
+                False,
+                f'При запросе в SpeechKit возникла ошибка с кодом: {decoded_data.get("error_code")}',
+            )
+
+    async def long_speech_to_text(self, file: bytes, id: str) -> tuple[bool, str]:
+        """
+        Converts a long voice message to text, recognizing its segments concurrently.
+        See SpeechKit.long_speech_to_text.
+        """
+        try:
+            segments = await run_blocking(list, OggOpus.segments(io.BytesIO(file), STT_SEGMENT_DURATION))
+        except ValueError as e:
+            logging.error(f"Не удалось разобрать голосовое (AsyncSpeechKit.long_speech_to_text): {e}")
+            return (False, "Не удалось разобрать голосовое сообщение")
+        logging.info(f"Голосовое разбито на {len(segments)} частей (AsyncSpeechKit.long_speech_to_text)")
+        results = await asyncio.gather(
+            *(self.speech_to_text(segment, id) for segment in segments)
+        )
+        for status, text in results:
+            if not status:
+                return (False, text)
+        return (True, " ".join(text for _, text in results if text))
+
+    async def synthesize(self, text: str, id: int) -> tuple[bool, bytes | str, str, bool]:
+        """
+        Converts text to speech using the audio cache. See SpeechKit.synthesize.
+        """
+        key = audio_cache.key(await run_blocking(self.synthesis_data, text, id))
+        audio = await run_blocking(audio_cache.get, key)
+        if audio is not None:
+            return True, audio, key, True
+        status, result = await self.text_to_speech(text, id)
+        if status:
+            await run_blocking(audio_cache.put, key, result)
+        return status, result, key, False
+
+    async def tts(self, message: telebot.types.Message | str, mode: int = 0, id: int = 0) -> tuple:
+        """
+        Converts text to speech. See SpeechKit.tts.
+        """
+        text = telebot.util.extract_arguments(message.text) if mode == 0 else message
+        idp = message.from_user.id if mode == 0 else id
+        if (
+            2 < len(text) < 251
+        ):
+            status, result, key, cached = await self.synthesize(text, idp)
+            if status:
+                if not cached:
+                    await run_blocking(self.charge_tts, idp, len(text))
+                logging.info("Успешная генерация (AsyncSpeechKit.tts)")
+                return (True, key, await run_blocking(self.audio_file, result))
+            else:
+                logging.warning(f"Проблема с запросом (AsyncSpeechKit.tts): {result}")
+                return (False, str(result))
+        else:
+            logging.warning("Ошибка со стороны пользователя (AsyncSpeechKit.tts)")
+            return (
+                False,
+                f"Проблема с запросом. {'Cлишком длинный текст' if len(text) > 250 else 'Слишком короткий текст'}",
+            )
+
+    async def stt(
+        self, message: telebot.types.Message, bot: AsyncTeleBot
+    ) -> tuple[bool, str]:
+        """
+        Converts a voice message to text. See SpeechKit.stt.
+        """
+        text = await run_blocking(self.dbc.get_transcript, message.voice.file_unique_id)
+        if text is not None:
+            logging.info("Расшифровка взята из кэша (AsyncSpeechKit.stt)")
+            return (True, text)
+        duration = message.voice.duration
+        id = message.from_user.id
+        stt_blocks_num = math.ceil(duration / 15)
+        if await run_blocking(self.dbc.charge, id, "stt_limit", stt_blocks_num) is not None:
+            try:
+                file_info = await bot.get_file(message.voice.file_id)
+                async with async_http_client.get_session().get(
+                    self.file_url(bot.token, file_info.file_path)
+                ) as download:
+                    if download.status != 200:
+                        raise aiohttp.ClientResponseError(
+                            download.request_info,
+                            download.history,
+                            status=download.status,
+                            message=f"Download file: {await download.text()}",
+                            headers=download.headers,
+                        )
+                    if duration > 30:
+                        result = await self.long_speech_to_text(await download.read(), str(id))
+                    else:
+                        result = await self.speech_to_text(
+                            download.content.iter_chunked(STT_STREAM_CHUNK), str(id)
+                        )
+            except Exception:
+                await run_blocking(self.dbc.charge, id, "stt_limit", -stt_blocks_num, strict=False)
+                raise
+            if result[0]:
+                await run_blocking(self.dbc.add_transcript, message.voice.file_unique_id, result[1])
+                logging.info("Успех (AsyncSpeechKit.stt)")
+                return (True, result[1])
+            else:
+                await run_blocking(self.dbc.charge, id, "stt_limit", -stt_blocks_num, strict=False)
+                return (False, result[1])
+        else:
+            logging.warning("Ошибка со стороны пользователя (AsyncSpeechKit.stt)")
+            return (
+                False,
+                "Проблема с запросом. У вас закончился лимит",
+            )
+
+
+class AsyncGPT(AsyncIOP, GPT):
+
+    async def count_tokens_in_dialogue(self, messages: list) -> int:
+        """
+        Sums the token counts stored with each message. See GPT.count_tokens_in_dialogue.
+        """
+        return sum([await self.message_tokens(row) for row in messages])
+
+    async def message_tokens(self, row: dict) -> int:
+        if row.get("tokens") is None:
+            row["tokens"] = await self.tokenize_messages([row])
+        return row["tokens"]
+
+    async def tokenize_messages(self, messages: list[dict]) -> int:
+        iam_token = await self.get_iam_token()
+
+        headers = {
+            "Authorization": f"Bearer {iam_token}",
+            "Content-Type": "application/json",
+        }
+
+        status, body = await async_http_client.post(
+            self.TOKENIZE_COMPLETION_URL,
+            json=self.tokenize_data(messages),
+            headers=headers,
+        )
+        return len(json.loads(body)["tokens"])
+
+    async def count_stored_tokens(self, user_id: int, messages: list[dict]):
+        """
+        Tokenizes the stored messages that have no token count yet. See GPT.count_stored_tokens.
+        """
+        missing = [row for row in messages if row.get("seq") is not None and row.get("tokens") is None]
+        if not missing:
+            return
+        try:
+            counts = [(row["seq"], await self.message_tokens(row)) for row in missing]
+        except Exception as e:
+            logging.error(f"Не удалось посчитать токены истории (AsyncGPT.count_stored_tokens): {e}")
+            return
+        await run_blocking(self.dbc.set_token_counts, user_id, counts)
+
+    async def increment_tokens_by_request(self, messages: list[dict]):
+        await run_blocking(self.store_tokens, await self.count_tokens_in_dialogue(messages))
+
+    async def ask_gpt(self, messages, max_tokens) -> tuple[str | None, dict[str, int]]:
+        iam_token = await self.get_iam_token()
+        headers = {
+            "Authorization": f"Bearer {iam_token}",
+            "Content-Type": "application/json",
+        }
+
+        try:
+            status, body = await async_http_client.post(
+                self.COMPLETION_URL, headers=headers, json=self.completion_data(messages, max_tokens)
+            )
+
+        except Exception as e:
+            logging.error(f"Произошла непредвиденная ошибка (AsyncGPT.ask_gpt): {e}")
+
+        else:
+            if status != 200:
+                logging.error(f"Ошибка при получении ответа (AsyncGPT.ask_gpt): {status}")
+            else:
+                result = json.loads(body)["result"]
+                answer = result["alternatives"][0]["message"]["text"]
+                tokens = self.used_tokens(result, messages, answer)
+                await run_blocking(self.store_tokens, tokens["total"])
+                return answer, tokens
+
+        return None, {}
+
+    async def fit_context(self, user_id: int, messages: list[dict]) -> tuple[list[dict], int]:
+        """
+        Keeps a request under GPT_CONTEXT_BUDGET tokens. See GPT.fit_context.
+        """
+        if self.context_tokens(messages) <= GPT_CONTEXT_BUDGET:
+            return messages, 0
+        if GPT_SUMMARIZE:
+            dropped, window = self.split_context(messages, GPT_CONTEXT_KEEP)
+            if dropped:
+                summary, tokens = await self.ask_gpt(self.summary_request(dropped), GPT_SUMMARY_TOKENS)
+                if summary is not None:
+                    row = self.summary_row(summary, tokens)
+                    await run_blocking(
+                        self.dbc.replace_messages, user_id, dropped[0]["seq"], dropped[-1]["seq"], row
+                    )
+                    return [row] + window, tokens["total"]
+        return self.split_context(messages, GPT_CONTEXT_BUDGET)[1], 0
+
+    async def asking_gpt(self, user_id: int, task: str | None = None, mode: int = 0) -> str:
+        message = await run_blocking(self.dbc.get_chat, user_id, GPT_CONTEXT_BUDGET)
+        if task:
+            message.append({"role": "user", "content": task})
+        context, summary_tokens = await self.fit_context(user_id, message)
+        await self.count_stored_tokens(user_id, context)
+        answer, tokens = await self.ask_gpt(context, 250 if mode == 1 else None)
+        if answer is None:
+            return answer
+        rows = [self.answer_row(context, answer, tokens, bool(task))]
+        await run_blocking(self.dbc.add_messages, user_id, context[-1:] + rows if task else rows)
+        await run_blocking(usage_counter.add, user_id, "gpt_limit", tokens["total"] + summary_tokens)
+        return answer
+
+    async def count_tokens(self, text: str) -> int:
+        iam_token = await self.get_iam_token()
+
+        headers = {
+            "Authorization": f"Bearer {iam_token}",
+            "Content-Type": "application/json",
+        }
+        data = {
+            "modelUri": f"gpt://{self.folder_id}/{self.gpt_model}/latest",
+            "messages": text,
+        }
+
+        status, body = await async_http_client.post(
+            self.TOKENIZE_URL,
+            json=data,
+            headers=headers,
+        )
+        return len(json.loads(body)["tokens"])
@@ -1,13 +1,12 @@
-import telebot, logging, os
+import telebot, logging
 from config import LOGS_PATH, TELEGRAM_TOKEN, ADMIN_LIST
-from iop import IOP, SpeechKit, GPT, Monetize, Database
+from iop import IOP, SpeechKit, GPT, Monetize, Database, ChatBot, MessageStream, SpeechPipeline, Markups, iam_manager, http_client, audio_cache, usage_counter
 
 db = Database()
 io = IOP()
 sk = SpeechKit()
 gpt = GPT()
 mt = Monetize()
-rm = telebot.types.ReplyKeyboardRemove()
 
 logging.basicConfig(
     filename=LOGS_PATH,
@@ -16,10 +15,11 @@ logging.basicConfig(
     filemode="w",
 )
 
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
+bot = ChatBot(TELEGRAM_TOKEN)
+GPT_ERROR = "Не удалось получить ответ от YandexGPT. Попробуй ещё раз"
 
 def is_ban(id):
-    return db.get_user_data(id).get("ban")
+    return db.is_banned(id)
 @bot.message_handler(commands=["fire_exit"])
 def fire_exit(message: telebot.types.Message):
     if message.from_user.id in ADMIN_LIST:
@@ -43,15 +43,7 @@ def help(message):
     bot.send_message(
         message.chat.id,
         "Список команд:\n/tts <текст> - озвучить текст\n/menu - показать меню\n/stt - расшифровать аудио",
-        reply_markup=(
-            telebot.util.quick_markup(
-                {
-                    "Язык разметки tts": {
-                        "url": "https://yandex.cloud/ru/docs/speechkit/tts/markup/tts-markup"
-                    }
-                }
-            )
-        ),
+        reply_markup=Markups.HELP,
     )
 
 
@@ -59,37 +51,24 @@ def help(message):
 def tts(message: telebot.types.Message):
     if not is_ban(message.from_user.id):
         bot.send_chat_action(message.chat.id, "record_voice")
-        result: bool | tuple[bool, str] = sk.tts(message)
-        if result == True:
+        result: tuple = sk.tts(message)
+        if result[0]:
             bot.send_message(message.chat.id, "Лови результат:")
 
-            with open(f"./data/temp/{str(message.from_user.id)}.ogg", "rb") as file:
+            with result[2] as file:
                 bot.send_chat_action(message.chat.id, "upload_voice")
-                bot.send_audio(
+                audio_cache.send_audio(
+                    bot,
                     message.chat.id,
+                    result[1],
                     file,
-                    reply_markup=telebot.util.quick_markup(
-                        {"Меню": {"callback_data": "menu"}}
-                    ),
+                    reply_markup=Markups.BACK,
                 )
-            os.remove(f"./data/temp/{str(message.from_user.id)}.ogg")
         elif not result[0]:
             bot.send_message(
                 message.chat.id,
                 result[1],
-                reply_markup=(
-                    telebot.util.quick_markup(
-                        {
-                            "Вики по кодам ошибок": {
-                                "url": "https://ru.wikipedia.org/wiki/Список_кодов_состояния_HTTP#Обзорный_список"
-                            },
-                            "Меню": {"callback_data": "menu"},
-                        },
-                        1,
-                    )
-                    if "кодом:" in result[1]
-                    else telebot.util.quick_markup({"Меню": {"callback_data": "menu"}})
-                ),
+                reply_markup=Markups.error(result[1]),
             )
 
 
@@ -110,25 +89,13 @@ def stt(message: telebot.types.Message):
             bot.send_message(
                 message.chat.id,
                 result[1],
-                reply_markup=telebot.util.quick_markup({"Меню": {"callback_data": "menu"}}),
+                reply_markup=Markups.BACK,
             )
         elif not result[0]:
             bot.send_message(
                 message.chat.id,
                 result[1],
-                reply_markup=(
-                    telebot.util.quick_markup(
-                        {
-                            "Вики по кодам ошибок": {
-                                "url": "https://ru.wikipedia.org/wiki/Список_кодов_состояния_HTTP#Обзорный_список"
-                            },
-                            "Меню": {"callback_data": "menu"},
-                        },
-                        1,
-                    )
-                    if "кодом:" in result[1]
-                    else telebot.util.quick_markup({"Меню": {"callback_data": "menu"}})
-                ),
+                reply_markup=Markups.error(result[1]),
             )
 
 
@@ -150,9 +117,7 @@ def menu(call):
         bot.send_message(
             message.chat.id,
             "Меню:",
-            reply_markup=io.get_inline_keyboard(
-                (("Выбрать голос", "voice"), ("Выбрать скорость", "speed"), ("Показать счет", "debt"),
-                 ("Отчистить историю чата", "clear"))))
+            reply_markup=Markups.MENU)
 
 
 @bot.callback_query_handler(func=lambda call: call.data == "clear")
@@ -161,7 +126,7 @@ def clear_history(call):
         call.message if call.message else call.callback_query.message
     )
     bot.delete_message(message.chat.id, message.message_id)
-    db.update_value(message.from_user.id, "gpt_chat", "[]")
+    db.clear_chat(message.chat.id)
     bot.send_message(message.chat.id, "История чата очищена")
 
 
@@ -173,10 +138,11 @@ def get_debt(call):
     bot.delete_message(message.chat.id, message.message_id)
     update_debts(message)
     id = message.chat.id
-    stt = round(mt.cost_calculation(id, 'stt'), 2)
-    tts = round(mt.cost_calculation(id, 'tts'), 2)
-    gpt = round(mt.cost_calculation(id, 'gpt'), 2)
-    all = round(mt.cost_calculation(id, 'stt') + mt.cost_calculation(id, 'tts') + mt.cost_calculation(id, 'gpt'), 2)
+    costs = mt.costs(id)
+    stt = round(costs['stt'], 2)
+    tts = round(costs['tts'], 2)
+    gpt = round(costs['gpt'], 2)
+    all = round(costs['all'], 2)
     bot.send_message(id,
                      f"Вот твой счет:\n\nЗа использование Speech to text: {stt}\nЗа использование Text to speech: {tts}"
                      f"\nЗа использование YaGPT: {gpt}\n **В Итоге:** {all}", parse_mode="Markdown")
@@ -192,7 +158,7 @@ def choose_voice(call):
     bot.send_message(
         message.chat.id,
         "Выбери голос:",
-        reply_markup=io.get_reply_markup(io.list_voices()),
+        reply_markup=io.voices_markup(),
     )
     bot.register_next_step_handler(message, select_voice)
 
@@ -203,15 +169,13 @@ def select_voice(message: telebot.types.Message):
         bot.send_message(
             message.chat.id,
             f'Теперь используется голос "{message.text}"\n\nВо избежание ошибок перевыберите эмоцию',
-            reply_markup=telebot.util.quick_markup(
-                {"Выбрать эмоцию": {"callback_data": "emotion"}}
-            ),
+            reply_markup=Markups.EMOTION,
         )
     else:
         bot.send_message(
             message.chat.id,
             "Неверный выбор. Попробуй ещё раз.",
-            reply_markup=io.get_reply_markup(io.list_voices()),
+            reply_markup=io.voices_markup(),
         )
         bot.register_next_step_handler(message, select_voice)
 
@@ -225,7 +189,7 @@ def choose_emotion(call):
     bot.send_message(
         message.chat.id,
         "Выбери эмоцию:",
-        reply_markup=io.get_reply_markup(io.list_emotions(message.chat.id)),
+        reply_markup=io.emotions_markup(message.chat.id),
     )
     bot.register_next_step_handler(message, select_emotion)
 
@@ -236,14 +200,14 @@ def select_emotion(message):
         bot.send_message(
             message.chat.id,
             f'Теперь используется эмоция "{message.text}"',
-            reply_markup=rm,
+            reply_markup=Markups.REMOVE,
         )
         menu(message)
     else:
         bot.send_message(
             message.chat.id,
             "Неверный выбор. Попробуй ещё раз.",
-            reply_markup=io.get_reply_markup(io.list_emotions(message.from_user.id)),
+            reply_markup=io.emotions_markup(message.from_user.id),
         )
         bot.register_next_step_handler(message, select_emotion)
 
@@ -287,69 +251,52 @@ def gptp(message: telebot.types.Message):
             text: tuple[bool, str] = sk.stt(message, bot)
             if text[0]:
                 bot.send_chat_action(message.chat.id, "typing")
-                answer = gpt.asking_gpt(message.from_user.id, text[1], 1)
-                bot.send_message(message.chat.id, answer, parse_mode="Markdown")
+                stream = MessageStream(bot, message.chat.id)
+                speech = SpeechPipeline(bot, sk, message.chat.id, message.from_user.id)
+
+                def on_update(answer: str):
+                    stream.update(answer)
+                    speech.update(answer)
+
+                answer = gpt.asking_gpt(message.from_user.id, text[1], 1, on_update)
+                if answer is None:
+                    speech.cancel()
+                    stream.finish(GPT_ERROR, reply_markup=Markups.error(GPT_ERROR))
+                    return
+                stream.finish(answer, parse_mode="Markdown")
                 bot.send_chat_action(message.chat.id, "record_voice")
-                result: bool | tuple[bool, str] = sk.tts(answer, 1, message.from_user.id)
-                if result == True:
-                    try:
-                        bot.send_chat_action(message.chat.id, "upload_voice")
-                        with open(f"./data/temp/{str(message.from_user.id)}.ogg", "rb") as file:
-                            bot.send_audio(
-                                message.chat.id,
-                                file,
-                                reply_markup=telebot.util.quick_markup(
-                                    {"Меню": {"callback_data": "menu"}}
-                                ),
-                            )
-                            os.remove(f"./data/temp/{str(message.from_user.id)}.ogg")
-                    except Exception as e:
-                        logging.warning(f"Ошибка при отправке голосового сообщения: {e}")
-                        bot.send_message(message.chat.id, f"При отправке голосового сообщения произошла ошибка: {e}")
-
-                else:
+                result: bool | tuple[bool, str] = speech.finish(
+                    answer,
+                    reply_markup=Markups.BACK,
+                )
+                if result != True:
                     bot.send_message(
                         message.chat.id,
                         result[1],
-                        reply_markup=(
-                            telebot.util.quick_markup(
-                                {
-                                    "Вики по кодам ошибок": {
-                                        "url": "https://ru.wikipedia.org/wiki/Список_кодов_состояния_HTTP#Обзорный_список"
-                                    },
-                                    "Меню": {"callback_data": "menu"},
-                                },
-                                1,
-                            )
-                            if "кодом:" in result[1]
-                            else telebot.util.quick_markup({"Меню": {"callback_data": "menu"}})
-                        ),
+                        reply_markup=Markups.error(result[1]),
                     )
 
             else:
                 bot.send_message(
                     message.chat.id,
                     text[1],
-                    reply_markup=(
-                        telebot.util.quick_markup(
-                            {
-                                "Вики по кодам ошибок": {
-                                    "url": "https://ru.wikipedia.org/wiki/Список_кодов_состояния_HTTP#Обзорный_список"
-                                },
-                                "Меню": {"callback_data": "menu"},
-                            },
-                            1,
-                        )
-                        if "кодом:" in text[1]
-                        else telebot.util.quick_markup({"Меню": {"callback_data": "menu"}})
-                    ),
+                    reply_markup=Markups.error(text[1]),
                 )
         else:
             bot.send_chat_action(message.chat.id, "typing")
-            answer = gpt.asking_gpt(message.from_user.id, message.text)
-            bot.send_message(message.chat.id, answer,
-                             reply_markup=telebot.util.quick_markup({"Меню": {"callback_data": "menu"}}),
-                             parse_mode="Markdown")
+            stream = MessageStream(bot, message.chat.id)
+            answer = gpt.asking_gpt(message.from_user.id, message.text, on_update=stream.update)
+            if answer is None:
+                stream.finish(GPT_ERROR, reply_markup=Markups.error(GPT_ERROR))
+                return
+            stream.finish(answer,
+                          reply_markup=Markups.BACK,
+                          parse_mode="Markdown")
 
 
 bot.infinity_polling()
+bot.executor.shutdown()
+usage_counter.stop()
+iam_manager.stop()
+http_client.close()
+Database.close()
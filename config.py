@@ -7,22 +7,59 @@ load_dotenv()
 LOGS_PATH = "./data/logs.log"
 JSON_PATH = "./data/users.json"
 VJSON_PATH = "./data/voices.json"
+VOICES_CHECK_INTERVAL = 10
 DB_PATH = "./data/database.db"
 TABLE_NAME = "texts"
+MESSAGES_TABLE = "messages"
+TRANSCRIPTS_TABLE = "transcripts"
+USAGE_TABLE = "usage_state"
+SCHEMA_TABLE = "schema_version"
+DB_TIMEOUT = 30
+DB_CACHED_STATEMENTS = 256
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 300
 
 FOLDER_ID = os.getenv("FOLDER_ID")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 
 TTS_LIMIT = 500
 STT_LIMIT = 500
+STT_SEGMENT_DURATION = 29
+STT_WORKERS = 4
+STT_STREAM_CHUNK = 64 * 1024
+STT_CACHE_SIZE = 10000
+TTS_WORKERS = 4
+TTS_CHUNK_LENGTH = 250
+TTS_CACHE_PATH = "./data/tts_cache"
+TTS_CACHE_SIZE = 50 * 1024 * 1024
+AUDIO_SPILL_SIZE = 20 * 1024 * 1024
 GPT_LIMIT = 1000
 ADMIN_LIST = [6303315695]
 MAX_USERS = 2
+WORKERS = 8
 
 IAM_TOKEN_ENDPOINT = (
     "http://169.254.169.254/computeMetadata/v1/instance/service-accounts/default/token"
 )
 GPT_MODEL = "yandexgpt-lite"
 TEMPERATURE = 0.5
+CHARS_PER_TOKEN = 3
+GPT_CONTEXT_BUDGET = 2000
+GPT_CONTEXT_KEEP = 1000
+GPT_SUMMARIZE = True
+GPT_SUMMARY_TOKENS = 200
+STREAM_EDIT_INTERVAL = 1.5
 IAM_TOKEN_PATH = "data/token_data.json"
+IAM_TOKEN_REFRESH_MARGIN = 300
+IAM_TOKEN_RETRY_INTERVAL = 10
 TOKENS_DATA_PATH = "data/DONT_DELETE_ME.json"
+USAGE_JOURNAL_PATH = "data/usage_journal.jsonl"
+USAGE_FLUSH_INTERVAL = 5
+
+HTTP_POOL_CONNECTIONS = 4
+HTTP_POOL_MAXSIZE = 16
+HTTP_TIMEOUT = (3.05, 60)
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+ASYNC_HTTP_LIMIT = 300
+ASYNC_HTTP_LIMIT_PER_HOST = 100
@@ -1,19 +1,57 @@
-import logging, json, requests, os, telebot, time, sqlite3, math, time
+import logging, json, requests, os, telebot, time, sqlite3, math, threading, contextlib, re, io, hashlib, tempfile, itertools, typing, types
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from config import (
     GPT_LIMIT,
     TEMPERATURE,
     GPT_MODEL,
     TOKENS_DATA_PATH,
+    USAGE_JOURNAL_PATH,
+    USAGE_FLUSH_INTERVAL,
     LOGS_PATH,
     FOLDER_ID,
     IAM_TOKEN_PATH,
     VJSON_PATH,
+    VOICES_CHECK_INTERVAL,
     IAM_TOKEN_ENDPOINT,
     DB_PATH,
     TABLE_NAME,
+    MESSAGES_TABLE,
+    TRANSCRIPTS_TABLE,
+    USAGE_TABLE,
+    SCHEMA_TABLE,
     TTS_LIMIT,
     STT_LIMIT,
+    STT_SEGMENT_DURATION,
+    STT_WORKERS,
+    STT_STREAM_CHUNK,
+    STT_CACHE_SIZE,
     MAX_USERS,
+    DB_TIMEOUT,
+    DB_CACHED_STATEMENTS,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    IAM_TOKEN_REFRESH_MARGIN,
+    IAM_TOKEN_RETRY_INTERVAL,
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_MAXSIZE,
+    HTTP_TIMEOUT,
+    HTTP_RETRIES,
+    HTTP_BACKOFF_FACTOR,
+    WORKERS,
+    CHARS_PER_TOKEN,
+    GPT_CONTEXT_BUDGET,
+    GPT_CONTEXT_KEEP,
+    GPT_SUMMARIZE,
+    GPT_SUMMARY_TOKENS,
+    STREAM_EDIT_INTERVAL,
+    TTS_WORKERS,
+    TTS_CHUNK_LENGTH,
+    TTS_CACHE_PATH,
+    TTS_CACHE_SIZE,
+    AUDIO_SPILL_SIZE,
 )
 
 
@@ -27,94 +65,905 @@ logging.basicConfig(
 )
 
 
-class IOP:
+class ChatExecutor:
+    """
+    Thread pool that runs tasks of different chats in parallel and tasks of the
+    same chat one after another, in the order they were submitted.
     """
-    The IOP class represents the Input-Output Processor.
 
-    It provides methods for user registration, IAM token retrieval, creating inline and reply keyboard markups,
-    listing available voices and emotions, and accessing user data from the database.
+    def __init__(self, workers: int = WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat")
+        self.lock = threading.Lock()
+        self.queues: dict[int, deque] = {}
+
+    def submit(self, key: int, task, *args):
+        """
+        Schedules a task behind the pending tasks of the same key.
+
+        Args:
+            key (int): The chat the task belongs to.
+            task (Callable): The function to run.
+        """
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is not None:
+                queue.append((task, args))
+                return
+            self.queues[key] = deque()
+        self.pool.submit(self.drain, key, task, args)
+
+    def drain(self, key: int, task, args: tuple):
+        while True:
+            try:
+                task(*args)
+            except Exception as e:
+                logging.exception(f"Ошибка при обработке обновления чата {key} (ChatExecutor.drain): {e}")
+            with self.lock:
+                queue = self.queues[key]
+                if not queue:
+                    del self.queues[key]
+                    return
+                task, args = queue.popleft()
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+class ChatBot(telebot.TeleBot):
     """
+    TeleBot that handles updates of different chats concurrently.
 
-    def __init__(self):
-        self.dbc = Database()
-    
-    def sing_up(self, id: int):
+    Updates of one chat are processed strictly in order, so a handler registered
+    with register_next_step_handler is always in place before the next message
+    of that chat is dispatched.
+    """
+
+    def __init__(self, token: str, workers: int = WORKERS, **kwargs):
+        super().__init__(token, threaded=False, **kwargs)
+        self.executor = ChatExecutor(workers)
+
+    @staticmethod
+    def chat_key(update: telebot.types.Update) -> int:
         """
-        Adds a new user to the database.
+        Returns the chat an update belongs to, or its own id if it has no chat.
+        """
+        message = update.message or update.edited_message
+        if message is not None:
+            return message.chat.id
+        if update.callback_query is not None:
+            if update.callback_query.message is not None:
+                return update.callback_query.message.chat.id
+            return update.callback_query.from_user.id
+        return update.update_id
+
+    def process_new_updates(self, updates: list[telebot.types.Update]):
+        for update in updates:
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+        for update in updates:
+            self.executor.submit(self.chat_key(update), super().process_new_updates, [update])
+
+    def stop_bot(self):
+        super().stop_bot()
+        self.executor.shutdown()
+
+
+class MessageStream:
+    """
+    Shows a growing text in a single Telegram message.
+
+    The message is sent with the first chunk of text and then edited at most once
+    per STREAM_EDIT_INTERVAL seconds, which keeps the bot within Telegram's limits
+    on message edits.
+    """
+
+    MAX_LENGTH = 4096
+
+    def __init__(self, bot: telebot.TeleBot, chat_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id: int | None = None
+        self.shown = ""
+        self.last_edit = 0.0
+
+    def show(self, text: str, **kwargs):
+        text = text[: self.MAX_LENGTH]
+        if self.message_id is None:
+            self.message_id = self.bot.send_message(self.chat_id, text, **kwargs).message_id
+        else:
+            self.bot.edit_message_text(text, self.chat_id, self.message_id, **kwargs)
+        self.shown = text
+        self.last_edit = time.monotonic()
+
+    def update(self, text: str):
+        """
+        Shows the text generated so far unless the last edit was too recent.
+        """
+        if not text.strip() or text[: self.MAX_LENGTH] == self.shown:
+            return
+        if time.monotonic() - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        try:
+            self.show(text)
+        except telebot.apihelper.ApiTelegramException as e:
+            logging.warning(f"Не удалось обновить сообщение (MessageStream.update): {e}")
+
+    def finish(self, text: str, **kwargs):
+        """
+        Shows the final text with its formatting and reply markup.
+
+        If Telegram can't parse the formatting, the text is shown as is.
+        """
+        try:
+            self.show(text, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if "not modified" in e.description:
+                return
+            if kwargs.pop("parse_mode", None) is None:
+                raise
+            self.show(text, **kwargs)
+
+
+class AudioCache:
+    """
+    Disk cache of synthesized speech keyed by a hash of the text and voice settings.
+
+    Files are evicted least recently used first once the cache outgrows `size`
+    bytes. The Telegram file_id of uploaded audio is kept next to the file, so a
+    repeated phrase is sent without being uploaded again.
+    """
+
+    def __init__(self, path: str = TTS_CACHE_PATH, size: int = TTS_CACHE_SIZE):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.file_ids: dict[str, str] = {}
+        os.makedirs(path, exist_ok=True)
+        files = sorted(
+            (entry for entry in os.scandir(path) if entry.name.endswith(".ogg")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in files:
+            key = entry.name[:-4]
+            self.entries[key] = entry.stat().st_size
+            try:
+                with open(self.file(key, "id"), "r") as file_id:
+                    self.file_ids[key] = file_id.read().strip()
+            except OSError:
+                pass
+        self.used = sum(self.entries.values())
+
+    @staticmethod
+    def key(data: dict[str, str]) -> str:
+        """
+        Hashes the text and voice settings of a synthesis request.
+        """
+        fields = [data["text"], data["voice"], data["emotion"], data["speed"]]
+        return hashlib.sha256(json.dumps(fields, ensure_ascii=False).encode()).hexdigest()
+
+    def file(self, key: str, extension: str = "ogg") -> str:
+        return os.path.join(self.path, f"{key}.{extension}")
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        try:
+            with open(self.file(key), "rb") as f:
+                audio = f.read()
+            os.utime(self.file(key))
+            return audio
+        except OSError:
+            self.remove(key)
+            return None
+
+    def put(self, key: str, audio: bytes):
+        try:
+            with open(self.file(key, "tmp"), "wb") as f:
+                f.write(audio)
+            os.replace(self.file(key, "tmp"), self.file(key))
+        except OSError as e:
+            logging.error(f"Не удалось сохранить аудио в кэш (AudioCache.put): {e}")
+            return
+        with self.lock:
+            self.used += len(audio) - self.entries.get(key, 0)
+            self.entries[key] = len(audio)
+            self.entries.move_to_end(key)
+            evicted = []
+            while self.used > self.size and len(self.entries) > 1:
+                old_key, old_size = self.entries.popitem(last=False)
+                self.used -= old_size
+                self.file_ids.pop(old_key, None)
+                evicted.append(old_key)
+        for old_key in evicted:
+            self.delete_files(old_key)
+
+    def remove(self, key: str):
+        with self.lock:
+            self.used -= self.entries.pop(key, 0)
+            self.file_ids.pop(key, None)
+        self.delete_files(key)
+
+    def delete_files(self, key: str):
+        for extension in ("ogg", "id"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.file(key, extension))
+
+    def set_file_id(self, key: str, file_id: str):
+        with self.lock:
+            if key not in self.entries:
+                return
+            self.file_ids[key] = file_id
+        try:
+            with open(self.file(key, "id"), "w") as f:
+                f.write(file_id)
+        except OSError as e:
+            logging.error(f"Не удалось сохранить file_id (AudioCache.set_file_id): {e}")
+
+    def send_audio(self, bot: telebot.TeleBot, chat_id: int, key: str, audio, **kwargs) -> telebot.types.Message:
+        """
+        Sends cached audio by its Telegram file_id, uploading it only the first time.
 
         Args:
-            id (int): The ID of the user.
+            bot (telebot.TeleBot): The bot to send with.
+            chat_id (int): The chat to send to.
+            key (str): The cache key of the audio.
+            audio: The audio to upload if it has no file_id yet.
+        """
+        file_id = self.file_ids.get(key)
+        if file_id is not None:
+            try:
+                return bot.send_audio(chat_id, file_id, **kwargs)
+            except telebot.apihelper.ApiTelegramException as e:
+                logging.warning(f"Не удалось отправить аудио по file_id (AudioCache.send_audio): {e}")
+                with self.lock:
+                    self.file_ids.pop(key, None)
+        message = bot.send_audio(chat_id, audio, **kwargs)
+        if message.audio is not None:
+            self.set_file_id(key, message.audio.file_id)
+        return message
+
+
+audio_cache = AudioCache()
+
+
+class SpeechPipeline:
+    """
+    Voices an answer sentence by sentence.
+
+    Complete sentences are synthesized in parallel as soon as they appear in the
+    (possibly still streaming) answer, and the audio is sent in order, so the first
+    part of the reply is heard before the rest is generated or synthesized.
+    """
+
+    SENTENCE_END = re.compile(r"[.!?…\n]+[\"»)]*\s+")
+    pool = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+
+    def __init__(self, bot: telebot.TeleBot, speechkit: "SpeechKit", chat_id: int, user_id: int):
+        self.bot = bot
+        self.speechkit = speechkit
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.offset = 0
+        self.pending: deque[tuple[str, Future]] = deque()
+        self.submitted = 0
+        self.symbols = 0
+        self.error: str | None = None
+
+    @classmethod
+    def split(cls, text: str) -> list[str]:
+        """
+        Packs the sentences of a text into chunks SpeechKit accepts in one request.
+
+        Fragments too short to be voiced on their own, like the "1." of a list item,
+        are joined to the next sentence; a trailing one is joined to the last chunk,
+        even if that makes it slightly longer than TTS_CHUNK_LENGTH.
+        """
+        chunks, short = [], ""
+        for sentence in re.split(r"(?<=[.!?…\n])\s+", text.strip()):
+            sentence = f"{short} {sentence}".strip()
+            short = ""
+            while len(sentence) > TTS_CHUNK_LENGTH:
+                cut = sentence.rfind(" ", 0, TTS_CHUNK_LENGTH)
+                cut = cut if cut > 0 else TTS_CHUNK_LENGTH
+                chunks.append(sentence[:cut])
+                sentence = sentence[cut:].strip()
+            if chunks and len(chunks[-1]) + len(sentence) < TTS_CHUNK_LENGTH:
+                chunks[-1] = f"{chunks[-1]} {sentence}"
+            elif len(sentence) > 2:
+                chunks.append(sentence)
+            else:
+                short = sentence
+        if short and chunks:
+            chunks[-1] = f"{chunks[-1]} {short}"
+        elif short:
+            chunks.append(short)
+        return chunks
+
+    def submit(self, text: str):
+        for chunk in self.split(text):
+            self.pending.append((chunk, self.pool.submit(self.speechkit.synthesize, chunk, self.user_id)))
+            self.submitted += 1
+
+    def update(self, text: str):
         """
-        ids = [user[1] for user in self.dbc.get_all_users()]
-        if id not in ids and MAX_USERS > len(ids):
-            self.dbc.add_user(id, 0)
+        Takes the answer generated so far, synthesizes its new complete sentences
+        and sends the audio that is ready.
+
+        The first sentence is synthesized on its own; later ones are collected until
+        there is enough text for half a chunk.
+        """
+        boundary = None
+        for boundary in self.SENTENCE_END.finditer(text, self.offset):
+            pass
+        if boundary is not None:
+            ready = text[self.offset : boundary.end()]
+            if (self.submitted and len(ready) >= TTS_CHUNK_LENGTH // 2) or (
+                not self.submitted and len(ready.strip()) > 2
+            ):
+                self.submit(ready)
+                self.offset = boundary.end()
+        while len(self.pending) > 1 and self.pending[0][1].done():
+            self.send(*self.pending.popleft())
+
+    def send(self, chunk: str, future: Future, **kwargs):
+        if self.error is not None:
             return
-        elif id not in ids:
-            self.dbc.add_user(id, 1)
+        try:
+            status, result, key, cached = future.result()
+        except Exception as e:
+            status, result = False, f"При запросе в SpeechKit возникла ошибка: {e}"
+        if not status:
+            logging.warning(f"Проблема с запросом (SpeechPipeline.send): {result}")
+            self.error = str(result)
             return
+        if not cached:
+            self.symbols += len(chunk)
+        try:
+            self.bot.send_chat_action(self.chat_id, "upload_voice")
+            with self.speechkit.audio_file(result) as audio:
+                audio_cache.send_audio(self.bot, self.chat_id, key, audio, **kwargs)
+        except Exception as e:
+            logging.warning(f"Ошибка при отправке голосового сообщения: {e}")
+            self.error = f"При отправке голосового сообщения произошла ошибка: {e}"
+
+    def finish(self, text: str, **kwargs) -> bool | tuple[bool, str]:
+        """
+        Voices the rest of the answer and waits until all audio is sent.
+
+        Args:
+            text (str): The whole answer.
+            **kwargs: Passed to send_audio of the last part, e.g. reply_markup.
+
+        Returns:
+            bool or tuple[bool, str]: True if everything was sent, otherwise a tuple
+            containing False and an error message.
+        """
+        self.submit(text[self.offset :])
+        self.offset = len(text)
+        if not self.submitted:
+            return (False, "Проблема с запросом. Слишком короткий текст")
+        while self.pending:
+            chunk, future = self.pending.popleft()
+            self.send(chunk, future, **(kwargs if not self.pending else {}))
+        if self.symbols:
+            self.speechkit.charge_tts(self.user_id, self.symbols)
+        return True if self.error is None else (False, self.error)
+
+    def cancel(self):
+        """
+        Drops the parts that have not been sent, e.g. when the answer failed midway,
+        and charges the audio that has already been sent.
+        """
+        while self.pending:
+            self.pending.popleft()[1].cancel()
+        if self.symbols:
+            self.speechkit.charge_tts(self.user_id, self.symbols)
+            self.symbols = 0
+
+
+class OggOpus:
+    """
+    Cuts an Ogg Opus voice message into independently recognizable segments.
+
+    The stream is split only on page boundaries where no packet continues into the
+    next page. Every segment gets the OpusHead/OpusTags header pages of the original
+    stream, renumbered pages, granule positions rebased to the start of the segment
+    and recomputed checksums, so each one is a valid file of its own.
+    """
+
+    SAMPLE_RATE = 48000
+    CONTINUED, LAST = 0x01, 0x04
+    NO_GRANULE = 0xFFFFFFFFFFFFFFFF
+    CRC_TABLE: list[int] = []
+
+    @staticmethod
+    def crc_table() -> list[int]:
+        table = []
+        for byte in range(256):
+            crc = byte << 24
+            for _ in range(8):
+                crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+            table.append(crc & 0xFFFFFFFF)
+        return table
+
+    @classmethod
+    def crc(cls, data: bytes) -> int:
+        """
+        Computes the Ogg page checksum (CRC-32, polynomial 0x04C11DB7, no reflection).
+        """
+        if not cls.CRC_TABLE:
+            cls.CRC_TABLE = cls.crc_table()
+        crc = 0
+        table = cls.CRC_TABLE
+        for byte in data:
+            crc = ((crc << 8) & 0xFFFFFFFF) ^ table[(crc >> 24) ^ byte]
+        return crc
+
+    @staticmethod
+    def read(stream: typing.BinaryIO, size: int) -> bytes:
+        data = stream.read(size)
+        while 0 < len(data) < size:
+            chunk = stream.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    @classmethod
+    def pages(cls, stream: typing.BinaryIO) -> typing.Iterator[dict]:
+        """
+        Reads the pages of an Ogg stream one by one, as they arrive.
+
+        Args:
+            stream (BinaryIO): The Ogg file or a download in progress.
+
+        Raises:
+            ValueError: If the data is not a well-formed Ogg stream.
+        """
+        offset = 0
+        while header := cls.read(stream, 27):
+            if len(header) < 27 or header[:4] != b"OggS":
+                raise ValueError(f"Нет страницы Ogg по смещению {offset}")
+            lacing = cls.read(stream, header[26])
+            body = cls.read(stream, sum(lacing))
+            if len(lacing) != header[26] or len(body) != sum(lacing):
+                raise ValueError(f"Обрезанная страница Ogg по смещению {offset}")
+            yield {
+                "type": header[5],
+                "granule": int.from_bytes(header[6:14], "little"),
+                "serial": header[14:18],
+                "lacing": lacing,
+                "body": body,
+            }
+            offset += 27 + len(lacing) + len(body)
+
+    @classmethod
+    def page(cls, page: dict, sequence: int, type: int, granule: int) -> bytes:
+        header = bytearray(b"OggS\x00")
+        header.append(type)
+        header += granule.to_bytes(8, "little")
+        header += page["serial"]
+        header += sequence.to_bytes(4, "little")
+        header += bytes(4)
+        header.append(len(page["lacing"]))
+        header += page["lacing"]
+        data = header + page["body"]
+        data[22:26] = cls.crc(data).to_bytes(4, "little")
+        return bytes(data)
+
+    @classmethod
+    def segments(cls, stream: typing.BinaryIO, seconds: float) -> typing.Iterator[bytes]:
+        """
+        Cuts an Ogg Opus stream into segments of at most `seconds` seconds.
+
+        A segment is yielded as soon as its last page has been read, so recognition of
+        the beginning of a download can start before the rest arrives.
+
+        Args:
+            stream (BinaryIO): The Ogg Opus file or a download in progress.
+            seconds (float): The maximum length of a segment.
+
+        Raises:
+            ValueError: If the stream is not a well-formed Ogg Opus stream.
+        """
+        pages = cls.pages(stream)
+        headers = []
+        for page in pages:
+            if page["granule"] != 0:
+                break
+            headers.append(page)
         else:
-            logging.debug("Пользователь уже зарегистрирован")
+            page = None
+        if not headers or headers[0]["body"][:8] != b"OpusHead":
+            raise ValueError("Поток не начинается с заголовка OpusHead")
+        pre_skip = int.from_bytes(headers[0]["body"][10:12], "little")
+        header = b"".join(
+            cls.page(header, sequence, header["type"], 0)
+            for sequence, header in enumerate(headers)
+        )
+        limit = int(seconds * cls.SAMPLE_RATE)
+
+        def build(start: int, group: list[dict]) -> bytes:
+            shift = start - pre_skip
+            body = []
+            for i, page in enumerate(group):
+                type = page["type"] & cls.CONTINUED
+                if i == len(group) - 1:
+                    type |= cls.LAST
+                granule = page["granule"]
+                if granule != cls.NO_GRANULE:
+                    granule -= shift
+                body.append(cls.page(page, len(headers) + i, type, granule))
+            return header + b"".join(body)
+
+        # Granules count the pre-skip samples too, so the first segment starts at pre_skip.
+        group, start, group_end = [], pre_skip, pre_skip
+        for page in itertools.chain([page] if page else [], pages):
+            granule = page["granule"]
+            if (
+                group
+                and not page["type"] & cls.CONTINUED
+                and granule != cls.NO_GRANULE
+                and granule - start > limit
+            ):
+                yield build(start, group)
+                start = group_end
+                group = []
+            group.append(page)
+            if granule != cls.NO_GRANULE:
+                group_end = granule
+        if group:
+            yield build(start, group)
 
-    def get_iam_token(self) -> str:
+    @classmethod
+    def split(cls, data: bytes, seconds: float) -> list[bytes]:
         """
-        Retrieves the IAM token for authentication.
+        Splits a voice message into segments of at most `seconds` seconds.
+
+        Args:
+            data (bytes): The Ogg Opus file.
+            seconds (float): The maximum length of a segment.
 
         Returns:
-            str: The IAM token.
+            list[bytes]: The segments in playback order. A stream that is short enough
+            or cannot be split is returned as the only segment.
         """
         try:
-            with open(IAM_TOKEN_PATH, "r") as token_file:
-                token_data = json.load(token_file)
+            segments = list(cls.segments(io.BytesIO(data), seconds))
+        except ValueError as e:
+            logging.warning(f"Не удалось разобрать голосовое (OggOpus.split): {e}")
+            return [data]
+        return segments if len(segments) > 1 else [data]
 
-            expires_at = token_data.get("expires_at")
 
-            if expires_at <= time.time():
-                logging.info(
-                    "Время жизни IAM-токена истек. Запуск получения нового токена. (IOP.get_iam_token)"
-                )
-                self.create_new_iam_token()
+class HTTPClient:
+    """
+    Shared HTTP session for Yandex Cloud calls.
 
-        except FileNotFoundError:
-            self.create_new_iam_token()
+    Keeps a pool of keep-alive connections per host, applies a default timeout
+    and retries 429/5xx responses with exponential backoff.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
 
-        with open(IAM_TOKEN_PATH, "r") as token_file:
-            token_data = json.load(token_file)
+    def __init__(self):
+        # Only connection failures and retryable statuses are retried: a request that
+        # timed out or broke while reading may already have been processed and billed.
+        retry = Retry(
+            total=HTTP_RETRIES,
+            read=0,
+            other=0,
+            backoff_factor=HTTP_BACKOFF_FACTOR,
+            status_forcelist=self.RETRY_STATUSES,
+            allowed_methods=frozenset({"GET", "POST"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_CONNECTIONS,
+            pool_maxsize=HTTP_POOL_MAXSIZE,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # A streamed body can be sent only once, so uploads are never retried.
+        self.upload_session = requests.Session()
+        self.upload_session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=HTTP_POOL_MAXSIZE,
+                max_retries=0,
+            ),
+        )
 
-        return token_data.get("access_token")
+    def get(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        return self.session.get(url, **kwargs)
 
-    @classmethod
-    def create_new_iam_token(cls):
+    def post(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        return self.session.post(url, **kwargs)
+
+    def upload(self, url: str, data: typing.Iterable[bytes], **kwargs) -> requests.Response:
         """
-        Creates a new IAM token.
+        Posts a body produced by an iterator with chunked transfer encoding.
+        """
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        return self.upload_session.post(url, data=data, **kwargs)
+
+    def close(self):
+        self.session.close()
+        self.upload_session.close()
+
+
+http_client = HTTPClient()
+
+
+class IAMToken:
+    """
+    Thread-safe in-memory holder of the IAM token.
+
+    The token is read from IAM_TOKEN_PATH once, refreshed by a background thread
+    IAM_TOKEN_REFRESH_MARGIN seconds before it expires and written back to disk
+    only when a new token has been received.
+    """
+
+    def __init__(self):
+        # Reentrant: refresh() updates the token while holding it.
+        self.lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.refresher: threading.Thread | None = None
+        self.access_token: str | None = None
+        self.expires_at = 0.0
+
+    def get(self) -> str | None:
+        """
+        Returns the current token. Blocks on a refresh only if the token has already expired.
+
+        Returns:
+            str: The IAM token, or None if it could not be obtained.
+        """
+        if self.refresher is None:
+            self.start()
+        if self.expires_at <= time.time():
+            logging.info(
+                "Время жизни IAM-токена истек. Запуск получения нового токена. (IAMToken.get)"
+            )
+            self.refresh()
+        return self.access_token
+
+    def start(self):
+        """
+        Loads the saved token and starts the background refresher.
+        """
+        with self.lock:
+            if self.refresher is not None:
+                return
+            try:
+                with open(IAM_TOKEN_PATH, "r") as token_file:
+                    token_data = json.load(token_file)
+                self.access_token = token_data.get("access_token")
+                self.expires_at = float(token_data.get("expires_at", 0))
+            except (FileNotFoundError, ValueError, TypeError):
+                logging.info("Сохраненный IAM-токен не найден (IAMToken.start)")
+            self.refresher = threading.Thread(target=self.run, name="iam-token", daemon=True)
+            self.refresher.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while True:
+            delay = max(
+                self.expires_at - IAM_TOKEN_REFRESH_MARGIN - time.time(),
+                IAM_TOKEN_RETRY_INTERVAL,
+            )
+            if self.stop_event.wait(delay):
+                return
+            self.refresh()
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Requests a new token unless another thread has just done so.
+
+        Args:
+            force (bool): Request a new token even if the current one is still fresh.
+
+        Returns:
+            bool: True if a usable token is held after the call.
+        """
+        with self.lock:
+            if not force and self.expires_at - IAM_TOKEN_REFRESH_MARGIN > time.time():
+                return True
+            token_data = self.fetch()
+            if token_data is None:
+                return self.expires_at > time.time()
+            self.update(token_data)
+            return True
+
+    def update(self, token_data: dict):
+        """
+        Replaces the held token and persists it.
+
+        Args:
+            token_data (dict): The token data as returned by `parse`.
+        """
+        with self.lock:
+            self.access_token = token_data["access_token"]
+            self.expires_at = token_data["expires_at"]
+            self.save(token_data)
+
+    @staticmethod
+    def parse(payload: dict) -> dict:
+        """
+        Converts a metadata service response to the stored token data.
+        """
+        return {
+            "access_token": payload.get("access_token"),
+            "expires_at": payload.get("expires_in") + time.time(),
+        }
+
+    def fetch(self) -> dict | None:
+        """
+        Requests a token from the metadata service.
+
+        Returns:
+            dict: The token data, or None if the request failed.
         """
         headers = {"Metadata-Flavor": "Google"}
 
         try:
-            response = requests.get(IAM_TOKEN_ENDPOINT, headers=headers)
+            response = http_client.get(IAM_TOKEN_ENDPOINT, headers=headers)
 
         except Exception as e:
-            logging.error("Не удалось выполнить запрос (IOP.create_new_iam_token):", e)
-            logging.info("Токен не получен (IOP.create_new_iam_token)")
+            logging.error(f"Не удалось выполнить запрос (IAMToken.fetch): {e}")
+            logging.info("Токен не получен (IAMToken.fetch)")
 
         else:
             if response.status_code == 200:
-                token_data = {
-                    "access_token": response.json().get("access_token"),
-                    "expires_at": response.json().get("expires_in") + time.time(),
-                }
+                return self.parse(response.json())
+
+            logging.error(
+                f"Ошибка при получении ответа (IAMToken.fetch): {response.status_code}"
+            )
+            logging.info("Токен не получен (IAMToken.fetch)")
 
-                with open(IAM_TOKEN_PATH, "w") as token_file:
+    def save(self, token_data: dict):
+        with self.lock:
+            try:
+                with open(f"{IAM_TOKEN_PATH}.tmp", "w") as token_file:
                     json.dump(token_data, token_file)
+                os.replace(f"{IAM_TOKEN_PATH}.tmp", IAM_TOKEN_PATH)
+            except OSError as e:
+                logging.error(f"Не удалось сохранить IAM-токен (IAMToken.save): {e}")
 
-            else:
-                logging.error(
-                    "Ошибка при получении ответа (IOP.create_new_iam_token):",
-                    response.status_code,
-                )
-                logging.info("Токен не получен (IOP.create_new_iam_token)")
+
+iam_manager = IAMToken()
+
+
+class VoiceCatalogue:
+    """
+    The voices and their emotions from voices.json.
+
+    The file is parsed once into an immutable mapping (voice -> frozenset of
+    emotions) together with reply keyboards serialized to JSON. Its modification time is checked
+    at most every VOICES_CHECK_INTERVAL seconds and the catalogue is rebuilt when
+    the file changes, so edits are picked up without a restart.
+    """
+
+    def __init__(self, path: str = VJSON_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime: int | None = None
+        self.checked = 0.0
+        self.voices: types.MappingProxyType[str, frozenset[str]] = types.MappingProxyType({})
+        self.names: tuple[str, ...] = ()
+        self.voice_markup: str | None = None
+        self.emotion_markups: types.MappingProxyType[str, str | None] = types.MappingProxyType({})
+
+    @staticmethod
+    def markup(values: list[str]) -> str | None:
+        markup = IOP.get_reply_markup(values)
+        return markup.to_json() if markup is not None else None
+
+    def refresh(self):
+        """
+        Rebuilds the catalogue if voices.json changed since it was last read.
+        """
+        now = time.monotonic()
+        if self.mtime is not None and now - self.checked < VOICES_CHECK_INTERVAL:
+            return
+        with self.lock:
+            if self.mtime is not None and now - self.checked < VOICES_CHECK_INTERVAL:
+                return
+            self.checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self.mtime:
+                    return
+                with open(self.path, "r") as json_file:
+                    data: dict[str, list[str]] = json.load(json_file)
+            except Exception as e:
+                logging.error(f"Не удалось прочитать список голосов (VoiceCatalogue.refresh): {e}")
+                return
+            # Readers take these attributes without the lock, so each is replaced whole.
+            self.emotion_markups = types.MappingProxyType(
+                {voice: self.markup(emotions) for voice, emotions in data.items()}
+            )
+            self.voice_markup = self.markup(data)
+            self.names = tuple(data)
+            self.voices = types.MappingProxyType(
+                {voice: frozenset(emotions) for voice, emotions in data.items()}
+            )
+            self.mtime = mtime
+            logging.info(f"Загружено голосов: {len(data)} (VoiceCatalogue.refresh)")
+
+    def list_voices(self) -> tuple[str, ...]:
+        self.refresh()
+        return self.names
+
+    def list_emotions(self, voice: str) -> frozenset[str]:
+        self.refresh()
+        return self.voices.get(voice, frozenset())
+
+    def voice_keyboard(self) -> str | None:
+        self.refresh()
+        return self.voice_markup
+
+    def emotion_keyboard(self, voice: str) -> str | None:
+        self.refresh()
+        return self.emotion_markups.get(voice)
+
+
+voice_catalogue = VoiceCatalogue()
+
+
+class IOP:
+    """
+    The IOP class represents the Input-Output Processor.
+
+    It provides methods for user registration, IAM token retrieval, creating inline and reply keyboard markups,
+    listing available voices and emotions, and accessing user data from the database.
+    """
+
+    def __init__(self):
+        self.dbc = Database()
+    
+    def sing_up(self, id: int):
+        """
+        Adds a new user to the database.
+
+        Args:
+            id (int): The ID of the user.
+        """
+        if self.dbc.check_user(id):
+            logging.debug("Пользователь уже зарегистрирован")
+            return
+        self.dbc.register_user(id, MAX_USERS)
+
+    def get_iam_token(self) -> str:
+        """
+        Retrieves the IAM token for authentication.
+
+        Returns:
+            str: The IAM token.
+        """
+        return iam_manager.get()
+
+    @classmethod
+    def create_new_iam_token(cls):
+        """
+        Creates a new IAM token.
+        """
+        iam_manager.refresh(force=True)
     
+    @staticmethod
     def get_inline_keyboard(
-        self, values: tuple[tuple[str, str],...]
+        values: tuple[tuple[str, str],...]
     ) -> telebot.types.InlineKeyboardMarkup:
         """
         Creates an inline keyboard markup.
@@ -134,8 +983,9 @@ class IOP:
             )
         return markup
 
+    @staticmethod
     def get_reply_markup(
-        self, values: list[str]
+        values: list[str]
     ) -> telebot.types.ReplyKeyboardMarkup | None:
         """
         Creates a reply markup.
@@ -172,16 +1022,16 @@ class IOP:
             return {}
             
         
-    def list_voices(self) -> list[str]:
+    def list_voices(self) -> tuple[str, ...]:
         """
         Lists available voices.
 
         Returns:
-            list[str]: The list of available voices.
+            tuple[str, ...]: The available voices.
         """
-        return list(self.read_json(VJSON_PATH).keys())
+        return voice_catalogue.list_voices()
 
-    def list_emotions(self, id: int) -> list[str]:
+    def list_emotions(self, id: int) -> frozenset[str]:
         """
         Lists available emotions for a user.
 
@@ -189,37 +1039,24 @@ class IOP:
             id (int): The ID of the user.
 
         Returns:
-            list[str]: The list of available emotions.
+            frozenset[str]: The emotions available for the user's voice.
         """
-        voice = self.db(id)["voice"]
-        return self.read_json(VJSON_PATH)[voice]
+        return voice_catalogue.list_emotions(self.dbc.get_settings(id).get("voice"))
 
-    def split_voice_file(self, file_path: str, id: int) -> list[str]:
+    def voices_markup(self) -> str | None:
         """
-        Splits a voice file into multiple files of 30 seconds each.
+        Returns the prebuilt reply keyboard with the available voices, serialized to JSON.
+        """
+        return voice_catalogue.voice_keyboard()
 
-        Args:
-            file_path (str): The path to the voice file.
+    def emotions_markup(self, id: int) -> str | None:
+        """
+        Returns the prebuilt reply keyboard with the emotions of the user's voice, serialized to JSON.
 
-        Returns:
-            list[str]: The list of paths to the split voice files.
+        Args:
+            id (int): The ID of the user.
         """
-        split_files = []
-        with open(file_path, "rb") as f:
-            voice_data = f.read()
-            voice_size = len(voice_data)
-            num_splits = math.ceil(
-                voice_size / (30 * 16000 * 2)
-            )  # Assuming 16kHz sample rate and 2 bytes per sample
-            for i in range(num_splits):
-                start = i * 30 * 16000 * 2
-                end = min((i + 1) * 30 * 16000 * 2, voice_size)
-                split_voice_data = voice_data[start:end]
-                split_file_path = f"./data/temp/{str(id)}_{i}.ogg"
-                with open(split_file_path, "wb") as split_file:
-                    split_file.write(split_voice_data)
-                split_files.append(split_file_path)
-        return split_files
+        return voice_catalogue.emotion_keyboard(self.dbc.get_settings(id).get("voice"))
 
     def db(self, id: int) -> dict[str, str | int]:
         """
@@ -234,7 +1071,70 @@ class IOP:
         return self.dbc.get_user_data(id)
 
 
+class Markups:
+    """
+    Keyboards the bot sends over and over, built and serialized to JSON once at startup.
+
+    Telegram requests take the JSON string in place of a markup object, so handlers
+    pass these as is instead of building and serializing a keyboard per message.
+    """
+
+    ERRORS_WIKI = "https://ru.wikipedia.org/wiki/Список_кодов_состояния_HTTP#Обзорный_список"
+    TTS_MARKUP_DOCS = "https://yandex.cloud/ru/docs/speechkit/tts/markup/tts-markup"
+
+    BACK = telebot.util.quick_markup({"Меню": {"callback_data": "menu"}}).to_json()
+    ERROR = telebot.util.quick_markup(
+        {
+            "Вики по кодам ошибок": {"url": ERRORS_WIKI},
+            "Меню": {"callback_data": "menu"},
+        },
+        1,
+    ).to_json()
+    HELP = telebot.util.quick_markup({"Язык разметки tts": {"url": TTS_MARKUP_DOCS}}).to_json()
+    EMOTION = telebot.util.quick_markup({"Выбрать эмоцию": {"callback_data": "emotion"}}).to_json()
+    MENU = IOP.get_inline_keyboard(
+        (("Выбрать голос", "voice"), ("Выбрать скорость", "speed"), ("Показать счет", "debt"),
+         ("Отчистить историю чата", "clear"))
+    ).to_json()
+    REMOVE = telebot.types.ReplyKeyboardRemove().to_json()
+
+    @classmethod
+    def error(cls, text: str) -> str:
+        """
+        Returns the keyboard for an error message: with a link to the list of HTTP
+        status codes if the error carries one, otherwise just the menu button.
+        """
+        return cls.ERROR if "кодом:" in text else cls.BACK
+
+
 class SpeechKit(IOP):
+    TTS_URL = "https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize"
+    STT_URL = "https://stt.api.cloud.yandex.net/speech/v1/stt:recognize"
+    stt_pool = ThreadPoolExecutor(max_workers=STT_WORKERS, thread_name_prefix="stt")
+
+    def synthesis_data(self, text: str, id: int) -> dict[str, str]:
+        """
+        Builds the form of a synthesis request from the user's voice settings.
+
+        Args:
+            text (str): The text to be converted to speech.
+            id (int): The ID of the user.
+
+        Returns:
+            dict: The form fields of the request.
+        """
+        user = self.dbc.get_settings(id)
+        return {
+            "text": text,
+            "lang": "ru-RU",
+            "voice": str(user["voice"]),
+            "emotion": str(user["emotion"]),
+            "speed": str(user["speed"]),
+            "folderId": FOLDER_ID,
+        }
+
+    def recognition_params(self) -> str:
+        return "&".join(["topic=general", f"folderId={FOLDER_ID}", "lang=ru-RU"])
 
     def text_to_speech(self, text: str, id: int):
         """
@@ -250,26 +1150,14 @@ class SpeechKit(IOP):
                 - If the request fails, the first element of the tuple is False and the second element is an error message.
         """
         iam_token = self.get_iam_token()
-        folder_id = FOLDER_ID
-        voice = str(self.db(id)["voice"])
-        emotion = str(self.db(id)["emotion"])
-        speed = str(self.db(id)["speed"])
 
         headers = {
             "Authorization": f"Bearer {iam_token}",
         }
-        data = {
-            "text": text,
-            "lang": "ru-RU",
-            "voice": voice,
-            "emotion": emotion,
-            "speed": speed,
-            "folderId": folder_id,
-        }
-        response = requests.post(
-            "https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize",
+        response = http_client.post(
+            self.TTS_URL,
             headers=headers,
-            data=data,
+            data=self.synthesis_data(text, id),
         )
 
         if response.status_code == 200:
@@ -283,12 +1171,41 @@ class SpeechKit(IOP):
                 f"При запросе в SpeechKit возникла ошибка c кодом: {response.status_code}",
             )
 
-    def speech_to_text(self, file: bytes, id: str) -> tuple[bool, str]:
+    @staticmethod
+    def file_url(token: str, file_path: str) -> str:
+        file_url = telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}"
+        return file_url.format(token, file_path)
+
+    @classmethod
+    def download(cls, bot: telebot.TeleBot, file_path: str) -> requests.Response:
+        """
+        Starts downloading a file from Telegram without reading its body.
+
+        Args:
+            bot (telebot.TeleBot): The bot the file was sent to.
+            file_path (str): The path returned by `bot.get_file`.
+
+        Returns:
+            requests.Response: The streamed response; close it when done.
+        """
+        response = http_client.get(
+            cls.file_url(bot.token, file_path),
+            stream=True,
+            proxies=telebot.apihelper.proxy,
+        )
+        if response.status_code != 200:
+            response.close()
+            raise telebot.apihelper.ApiHTTPException("Download file", response)
+        response.raw.decode_content = True
+        return response
+
+    def speech_to_text(self, file: bytes | typing.Iterator[bytes], id: str) -> tuple[bool, str]:
         """
         Converts speech to text using the Yandex SpeechKit API.
 
         Args:
-            file (bin): The audio file to be converted.
+            file (bytes | Iterator[bytes]): The audio file to be converted, or its chunks,
+                which are uploaded as they are produced (without retries).
             id (str): The ID associated with the audio file.
 
         Returns:
@@ -302,16 +1219,14 @@ class SpeechKit(IOP):
             the second element is an error message.
         """
         iam_token = self.get_iam_token()
-        folder_id = FOLDER_ID
-
-        params = "&".join(["topic=general", f"folderId={folder_id}", "lang=ru-RU"])
 
         headers = {
             "Authorization": f"Bearer {iam_token}",
         }
 
-        response = requests.post(
-            f"https://stt.api.cloud.yandex.net/speech/v1/stt:recognize?{params}",
+        post = http_client.post if isinstance(file, bytes) else http_client.upload
+        response = post(
+            f"{self.STT_URL}?{self.recognition_params()}",
             headers=headers,
             data=file,
         )
@@ -328,7 +1243,82 @@ class SpeechKit(IOP):
                 f'При запросе в SpeechKit возникла ошибка с кодом: {decoded_data.get("error_code")}',
             )
 
-    def tts(self, message: telebot.types.Message | str, mode: int = 0, id: int = 0) -> bool | tuple[bool, str]:
+    def long_speech_to_text(self, file: bytes | typing.BinaryIO, id: str) -> tuple[bool, str]:
+        """
+        Converts a voice message longer than the recognition limit to text.
+
+        The audio is cut into segments of at most STT_SEGMENT_DURATION seconds (see
+        OggOpus.segments), each segment is sent for recognition as soon as it has been
+        read, and the texts are joined in playback order.
+
+        Args:
+            file (bytes | BinaryIO): The Ogg Opus audio file or a download in progress.
+            id (str): The ID associated with the audio file.
+
+        Returns:
+            tuple: The same as `speech_to_text`; the first failed segment fails the whole message.
+        """
+        stream = io.BytesIO(file) if isinstance(file, bytes) else file
+        futures = []
+        try:
+            for segment in OggOpus.segments(stream, STT_SEGMENT_DURATION):
+                futures.append(self.stt_pool.submit(self.speech_to_text, segment, id))
+        except ValueError as e:
+            # Segments that have not been sent yet are not recognized (and not billed) for nothing.
+            for future in futures:
+                future.cancel()
+            logging.error(f"Не удалось разобрать голосовое (SpeechKit.long_speech_to_text): {e}")
+            return (False, "Не удалось разобрать голосовое сообщение")
+        logging.info(f"Голосовое разбито на {len(futures)} частей (SpeechKit.long_speech_to_text)")
+        results = [future.result() for future in futures]
+        for status, text in results:
+            if not status:
+                return (False, text)
+        return (True, " ".join(text for _, text in results if text))
+
+    def synthesize(self, text: str, id: int) -> tuple[bool, bytes | str, str, bool]:
+        """
+        Converts text to speech, reusing the audio cached for the same text and voice settings.
+
+        Args:
+            text (str): The text to be converted to speech.
+            id (int): The ID of the user whose voice settings are used.
+
+        Returns:
+            tuple: Whether the conversion succeeded, the audio or an error message, the
+            AudioCache key and whether the audio was taken from the cache.
+        """
+        key = audio_cache.key(self.synthesis_data(text, id))
+        audio = audio_cache.get(key)
+        if audio is not None:
+            return True, audio, key, True
+        status, result = self.text_to_speech(text, id)
+        if status:
+            audio_cache.put(key, result)
+        return status, result, key, False
+
+    @staticmethod
+    def audio_file(audio: bytes, name: str = "audio.ogg") -> io.BytesIO | tempfile._TemporaryFileWrapper:
+        """
+        Wraps audio into a file object that can be uploaded to Telegram.
+
+        The audio stays in memory; only audio larger than AUDIO_SPILL_SIZE is written
+        to a temporary file with a unique name, which is deleted when closed.
+
+        Args:
+            audio (bytes): The audio.
+            name (str): The file name shown in Telegram.
+        """
+        if len(audio) <= AUDIO_SPILL_SIZE:
+            file = io.BytesIO(audio)
+            file.name = name
+            return file
+        file = tempfile.NamedTemporaryFile(dir="./data/temp", suffix=".ogg")
+        file.write(audio)
+        file.seek(0)
+        return file
+
+    def tts(self, message: telebot.types.Message | str, mode: int = 0, id: int = 0) -> tuple:
         """
         Converts text to speech.
 
@@ -337,23 +1327,20 @@ class SpeechKit(IOP):
             mode (int): The mode of the conversion. If mode is 1, the text will be converted to speech.
             id (int): The ID associated with the audio file.
         Returns:
-            bool or tuple[bool, str]: True if the conversion is successful, otherwise a tuple
-            containing False and an error message.
+            tuple: True, the AudioCache key and the audio as a file object (see `audio_file`)
+            if the conversion is successful, otherwise False and an error message.
         """
         text = telebot.util.extract_arguments(message.text) if mode == 0 else message
         idp = message.from_user.id if mode == 0 else id
         if (
             2 < len(text) < 251
         ):
-            status, result = self.text_to_speech(text, idp)
+            status, result, key, cached = self.synthesize(text, idp)
             if status:
-                with open(f"./data/temp/{str(idp)}.ogg", "wb") as f:
-                    f.write(result)
-                self.dbc.update_value(
-                    idp, "tts_limit", int(self.db(idp)["tts_limit"]) - len(text)
-                )
+                if not cached:
+                    self.charge_tts(idp, len(text))
                 logging.info("Успешная генерация (SpeechKit.tts)")
-                return True
+                return (True, key, self.audio_file(result))
             else:
                 logging.warning(f"Проблема с запросом (SpeechKit.tts): {result}")
                 return (False, str(result))
@@ -364,47 +1351,43 @@ class SpeechKit(IOP):
                 f"Проблема с запросом. {'Cлишком длинный текст' if len(text) > 250 else 'Слишком короткий текст'}",
             )
 
+    def charge_tts(self, id: int, symbols: int):
+        """
+        Subtracts synthesized symbols from the user's tts_limit.
+        """
+        usage_counter.add(id, "tts_limit", symbols)
+
     def stt(
         self, message: telebot.types.Message, bot: telebot.TeleBot
     ) -> tuple[bool, str]:
-        db = self.db(message.from_user.id)
+        text = self.dbc.get_transcript(message.voice.file_unique_id)
+        if text is not None:
+            logging.info("Расшифровка взята из кэша (SpeechKit.stt)")
+            return (True, text)
         duration = message.voice.duration
         id = message.from_user.id
         stt_blocks_num = math.ceil(duration / 15)
-        if db["stt_limit"] - stt_blocks_num >= 0:
-            file_id = message.voice.file_id
-            file_info = bot.get_file(file_id)
-            file = bot.download_file(file_info.file_path)
-            if duration > 30:
-                """
-                with open(f"./data/temp/{str(id)}_full.ogg", "wb") as f:
-                    f.write(file)
-                files = self.split_voice_file(f"./data/temp/{str(id)}_full.ogg", id)
-                for filer in files:
-                    with open(filer, "rb") as f:
-                        result = self.speech_to_text(f, id)
-                    if result[0] == True:
-                        text += result[1]
+        if self.dbc.charge(id, "stt_limit", stt_blocks_num) is not None:
+            try:
+                file_id = message.voice.file_id
+                file_info = bot.get_file(file_id)
+                with self.download(bot, file_info.file_path) as download:
+                    if duration > 30:
+                        result = self.long_speech_to_text(download.raw, str(id))
                     else:
-                        os.remove(f"./data/temp/{str(id)}_full.ogg")
-                        return (False, result[1])
-                    os.remove(filer)
-                os.remove(f"./data/temp/{str(id)}_full.ogg")
-                """
-                return (
-                    False,
-                    "Фича в разработке а пока голосовые только до 30 секунд)",
-                )
+                        result = self.speech_to_text(
+                            download.iter_content(STT_STREAM_CHUNK), str(id)
+                        )
+            except Exception:
+                self.dbc.charge(id, "stt_limit", -stt_blocks_num, strict=False)
+                raise
+            if result[0]:
+                self.dbc.add_transcript(message.voice.file_unique_id, result[1])
+                logging.info("Успех (SpeechKit.stt)")
+                return (True, result[1])
             else:
-                result = self.speech_to_text(file, str(id))
-                if result[0]:
-                    self.dbc.update_value(
-                        id, "stt_limit", db["stt_limit"] - stt_blocks_num
-                    )
-                    logging.info("Успех (SpeechKit.stt)")
-                    return (True, result[1])
-                else:
-                    return (False, result[1])
+                self.dbc.charge(id, "stt_limit", -stt_blocks_num, strict=False)
+                return (False, result[1])
         else:
             logging.warning("Ошибка со стороны пользователя (SpeechKit.stt)")
             return (
@@ -414,6 +1397,9 @@ class SpeechKit(IOP):
 
 
 class GPT(IOP):
+    COMPLETION_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+    TOKENIZE_COMPLETION_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/tokenizeCompletion"
+    TOKENIZE_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/tokenize"
 
     def __init__(self):
         super().__init__()
@@ -424,13 +1410,7 @@ class GPT(IOP):
         self.gpt_model = GPT_MODEL
         self.tokens_data_path = TOKENS_DATA_PATH
 
-    def count_tokens_in_dialogue(self, messages: list) -> int:
-        iam_token = self.get_iam_token()
-
-        headers = {
-            "Authorization": f"Bearer {iam_token}",
-            "Content-Type": "application/json",
-        }
+    def tokenize_data(self, messages: list[dict]) -> dict:
         data = {
             "modelUri": f"gpt://{self.folder_id}/{self.gpt_model}/latest",
             "maxTokens": self.max_tokens,
@@ -439,83 +1419,304 @@ class GPT(IOP):
 
         for row in messages:
             data["messages"].append({"role": row["role"], "text": row["content"]})
+        return data
+
+    def completion_data(self, messages: list[dict], max_tokens: int | None, stream: bool = False) -> dict:
+        max_tokens = self.max_tokens if max_tokens is None else max_tokens
+        data = {
+            "modelUri": f"gpt://{self.folder_id}/{self.gpt_model}/latest",
+            "completionOptions": {
+                "stream": stream,
+                "temperature": self.temperature,
+                "maxTokens": max_tokens,
+            },
+            "messages": [],
+        }
+
+        for row in messages:
+            data["messages"].append({"role": row["role"], "text": row["content"]})
+        return data
+
+    def count_tokens_in_dialogue(self, messages: list) -> int:
+        """
+        Sums the token counts stored with each message of the dialogue.
+
+        Only messages without a stored count are sent to the tokenizer, one at a
+        time, and their count is saved into the message.
+        """
+        return sum(self.message_tokens(row) for row in messages)
+
+    def message_tokens(self, row: dict) -> int:
+        if row.get("tokens") is None:
+            row["tokens"] = self.tokenize_messages([row])
+        return row["tokens"]
+
+    def tokenize_messages(self, messages: list[dict]) -> int:
+        iam_token = self.get_iam_token()
+
+        headers = {
+            "Authorization": f"Bearer {iam_token}",
+            "Content-Type": "application/json",
+        }
 
         return len(
-            requests.post(
-                "https://llm.api.cloud.yandex.net/foundationModels/v1/tokenizeCompletion",
-                json=data,
+            http_client.post(
+                self.TOKENIZE_COMPLETION_URL,
+                json=self.tokenize_data(messages),
                 headers=headers,
             ).json()["tokens"]
         )
 
-    def increment_tokens_by_request(self, messages: list[dict]):
+    def count_stored_tokens(self, user_id: int, messages: list[dict]):
+        """
+        Tokenizes the stored messages that have no token count yet, such as rows migrated
+        from gpt_chat, one message at a time, and saves the counts to the history, so
+        each of them is tokenized only once.
+
+        On a tokenizer failure the counts stay missing and are estimated instead.
+        """
+        missing = [row for row in messages if row.get("seq") is not None and row.get("tokens") is None]
+        if not missing:
+            return
         try:
-            with open(self.tokens_data_path, "r") as token_file:
-                tokens_count = json.load(token_file)["tokens_count"]
+            counts = [(row["seq"], self.message_tokens(row)) for row in missing]
+        except Exception as e:
+            logging.error(f"Не удалось посчитать токены истории (GPT.count_stored_tokens): {e}")
+            return
+        self.dbc.set_token_counts(user_id, counts)
 
-        except FileNotFoundError:
-            tokens_count = 0
+    def store_tokens(self, current_tokens_used: int):
+        """
+        Adds the tokens of one request to the all-time counter in TOKENS_DATA_PATH.
+        The file is written in batches by UsageCounter.
+        """
+        usage_counter.add_tokens(current_tokens_used)
 
-        current_tokens_used = self.count_tokens_in_dialogue(messages)
-        tokens_count += current_tokens_used
+    def increment_tokens_by_request(self, messages: list[dict]):
+        self.store_tokens(self.count_tokens_in_dialogue(messages))
+
+    def estimate_tokens(self, messages: list[dict]) -> int:
+        """
+        Approximates the token count of messages without calling the tokenizer.
+        """
+        return sum(math.ceil(len(row["content"] or "") / CHARS_PER_TOKEN) for row in messages)
 
-        with open(self.tokens_data_path, "w") as token_file:
-            json.dump({"tokens_count": tokens_count}, token_file)
+    def used_tokens(self, result: dict, messages: list[dict], answer: str) -> dict[str, int]:
+        """
+        Returns the tokens spent on a completion.
+
+        Takes the `usage` counters of the completion response and falls back to a
+        local estimate if they are missing, so accounting costs no extra request.
+
+        Args:
+            result (dict): The `result` object of the completion response.
+            messages (list[dict]): The messages sent to the model.
+            answer (str): The generated answer.
 
-    def ask_gpt(self, messages, max_tokens):
+        Returns:
+            dict[str, int]: The "input", "completion" and "total" token counts.
+        """
+        usage = result.get("usage") or {}
+        input_tokens = (
+            int(usage["inputTextTokens"]) if usage.get("inputTextTokens") is not None
+            else self.estimate_tokens(messages)
+        )
+        completion_tokens = (
+            int(usage["completionTokens"]) if usage.get("completionTokens") is not None
+            else self.estimate_tokens([{"role": "assistant", "content": answer}])
+        )
+        total_tokens = (
+            int(usage["totalTokens"]) if usage.get("totalTokens") is not None
+            else input_tokens + completion_tokens
+        )
+        return {"input": input_tokens, "completion": completion_tokens, "total": total_tokens}
+
+    def answer_row(self, messages: list[dict], answer: str, tokens: dict[str, int], new_message: bool) -> dict:
+        """
+        Builds the history entry of an answer together with its token count.
+
+        The count of a newly asked message is derived from the input tokens of the
+        completion, so it doesn't need a tokenizer call of its own.
+
+        Args:
+            messages (list[dict]): The messages sent to the model.
+            answer (str): The generated answer.
+            tokens (dict[str, int]): The counts returned by `used_tokens`.
+            new_message (bool): Whether the last message was added by this request.
+
+        Returns:
+            dict: The history entry of the answer.
+        """
+        if new_message:
+            history = messages[:-1]
+            if all(row.get("tokens") is not None for row in history):
+                question_tokens = tokens["input"] - sum(row["tokens"] for row in history)
+                if question_tokens > 0:
+                    messages[-1]["tokens"] = question_tokens
+        return {"role": "assistant", "content": answer, "tokens": tokens["completion"]}
+
+    def context_tokens(self, messages: list[dict]) -> int:
+        """
+        Sums the stored token counts, estimating the messages that have none.
+        """
+        return sum(
+            row["tokens"] if row.get("tokens") is not None else self.estimate_tokens([row])
+            for row in messages
+        )
+
+    def split_context(self, messages: list[dict], budget: int) -> tuple[list[dict], list[dict]]:
+        """
+        Splits the history into old turns and the newest turns that fit into the budget.
+
+        The last message is always kept and the kept part starts with a user message.
+
+        Returns:
+            tuple[list[dict], list[dict]]: The dropped and the kept messages.
+        """
+        start = len(messages)
+        used = 0
+        while start > 0:
+            row_tokens = self.context_tokens([messages[start - 1]])
+            if used + row_tokens > budget and start < len(messages):
+                break
+            used += row_tokens
+            start -= 1
+        while start < len(messages) - 1 and messages[start]["role"] != "user":
+            start += 1
+        return messages[:start], messages[start:]
+
+    def summary_request(self, messages: list[dict]) -> list[dict]:
+        transcript = "\n".join(f'{row["role"]}: {row["content"]}' for row in messages)
+        return [
+            {
+                "role": "system",
+                "content": "Кратко перескажи диалог пользователя с ассистентом. "
+                "Сохрани факты о пользователе, его просьбы и договоренности.",
+            },
+            {"role": "user", "content": transcript},
+        ]
+
+    def fit_context(self, user_id: int, messages: list[dict]) -> tuple[list[dict], int]:
+        """
+        Keeps a request under GPT_CONTEXT_BUDGET tokens.
+
+        Old turns are left out of the request. With GPT_SUMMARIZE they are replaced by
+        a summary, which is stored in place of them so it is generated only once per
+        GPT_CONTEXT_BUDGET - GPT_CONTEXT_KEEP tokens of conversation.
+
+        Args:
+            user_id (int): The ID of the user.
+            messages (list[dict]): The newest history as returned by Database.get_chat,
+                ending with the new message.
+
+        Returns:
+            tuple[list[dict], int]: The messages to send and the tokens spent on summarizing.
+        """
+        if self.context_tokens(messages) <= GPT_CONTEXT_BUDGET:
+            return messages, 0
+        if GPT_SUMMARIZE:
+            dropped, window = self.split_context(messages, GPT_CONTEXT_KEEP)
+            if dropped:
+                summary, tokens = self.ask_gpt(self.summary_request(dropped), GPT_SUMMARY_TOKENS)
+                if summary is not None:
+                    row = self.summary_row(summary, tokens)
+                    self.dbc.replace_messages(user_id, dropped[0]["seq"], dropped[-1]["seq"], row)
+                    return [row] + window, tokens["total"]
+        return self.split_context(messages, GPT_CONTEXT_BUDGET)[1], 0
+
+    def summary_row(self, summary: str, tokens: dict[str, int]) -> dict:
+        return {
+            "role": "system",
+            "content": f"Краткое содержание начала диалога: {summary}",
+            "tokens": tokens["completion"],
+        }
+
+    def read_completion(self, response: requests.Response, on_update=None) -> dict:
+        """
+        Reads the `result` object of a completion response.
+
+        A streamed response is a sequence of JSON lines, each holding the whole text
+        generated so far; `on_update` is called with that text for every line.
+
+        Args:
+            response (requests.Response): The completion response.
+            on_update (Callable[[str], None]): Receives the partial answer of a streamed response.
+
+        Returns:
+            dict: The `result` object of the last line.
+        """
+        if on_update is None:
+            return response.json()["result"]
+        result = None
+        for line in response.iter_lines():
+            if line:
+                result = json.loads(line)["result"]
+                on_update(result["alternatives"][0]["message"]["text"])
+        return result
+
+    def ask_gpt(self, messages, max_tokens, on_update=None) -> tuple[str | None, dict[str, int]]:
+        """
+        Requests a completion for the messages.
+
+        Args:
+            messages (list[dict]): The messages to send.
+            max_tokens (int): The limit of the answer length, GPT_LIMIT if None.
+            on_update (Callable[[str], None]): If given, the answer is streamed and the
+                callable receives the text generated so far as it grows.
+
+        Returns:
+            tuple[str | None, dict[str, int]]: The answer and the tokens spent (see `used_tokens`),
+            or (None, {}) on failure.
+        """
         iam_token = self.get_iam_token()
-        max_tokens = self.max_tokens if max_tokens is None else max_tokens
-        url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
         headers = {
             "Authorization": f"Bearer {iam_token}",
             "Content-Type": "application/json",
         }
 
-        data = {
-            "modelUri": f"gpt://{self.folder_id}/{self.gpt_model}/latest",
-            "completionOptions": {
-                "stream": False,
-                "temperature": self.temperature,
-                "maxTokens": max_tokens,
-            },
-            "messages": [],
-        }
-
-        for row in messages:
-            data["messages"].append({"role": row["role"], "text": row["content"]})
-
+        stream = on_update is not None
+        response = None
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = http_client.post(
+                self.COMPLETION_URL,
+                headers=headers,
+                json=self.completion_data(messages, max_tokens, stream),
+                stream=stream,
+            )
+            if response.status_code == 200:
+                result = self.read_completion(response, on_update)
 
         except Exception as e:
-            logging.error("Произошла непредвиденная ошибка.", e)
+            logging.error(f"Произошла непредвиденная ошибка (GPT.ask_gpt): {e}")
 
         else:
             if response.status_code != 200:
-                logging.error("Ошибка при получении ответа:", response.status_code)
+                logging.error(f"Ошибка при получении ответа (GPT.ask_gpt): {response.status_code}")
             else:
-                result = response.json()["result"]["alternatives"][0]["message"]["text"]
-                messages.append({"role": "assistant", "content": result})
-                self.increment_tokens_by_request(messages)
-                return result
+                answer = result["alternatives"][0]["message"]["text"]
+                tokens = self.used_tokens(result, messages, answer)
+                self.store_tokens(tokens["total"])
+                return answer, tokens
 
-        with open(TOKENS_DATA_PATH, "r") as f:
-            logging.info(
-                f"За всё время израсходовано: {json.load(f)['tokens_count']} токенов"
-            )
-    
-    def asking_gpt(self, user_id: int, task: str | None = None, mode: int = 0) -> str:
-        try:
-            message = json.loads(self.db(user_id)["gpt_chat"])
-        except Exception as e:
-            message = []
+        finally:
+            # A streamed response holds its pooled connection until it is closed.
+            if response is not None:
+                response.close()
+
+        return None, {}
+
+    def asking_gpt(self, user_id: int, task: str | None = None, mode: int = 0, on_update=None) -> str:
+        message = self.dbc.get_chat(user_id, GPT_CONTEXT_BUDGET)
         if task:
             message.append({"role": "user", "content": task})
-        answer = self.ask_gpt(message, 250 if mode == 1 else None)
-        message.append({"role": "assistant", "content": answer})
-        current_tokens_used = self.count_tokens_in_dialogue(message)
-        self.dbc.update_value(user_id, "gpt_limit", self.db(user_id)["gpt_limit"]-current_tokens_used)
-        self.dbc.update_value(user_id, "gpt_chat", json.dumps(message, ensure_ascii=False))
+        context, summary_tokens = self.fit_context(user_id, message)
+        self.count_stored_tokens(user_id, context)
+        answer, tokens = self.ask_gpt(context, 250 if mode == 1 else None, on_update)
+        if answer is None:
+            return answer
+        rows = [self.answer_row(context, answer, tokens, bool(task))]
+        self.dbc.add_messages(user_id, context[-1:] + rows if task else rows)
+        usage_counter.add(user_id, "gpt_limit", tokens["total"] + summary_tokens)
         return answer
     
     def count_tokens(self, text: str) -> int:
@@ -531,113 +1732,525 @@ class GPT(IOP):
         }
 
         return len(
-            requests.post(
-                "https://llm.api.cloud.yandex.net/foundationModels/v1/tokenize",
+            http_client.post(
+                self.TOKENIZE_URL,
                 json=data,
                 headers=headers,
             ).json()["tokens"]
         )
 
-    @classmethod
-    def create_new_iam_token(cls):
-        headers = {"Metadata-Flavor": "Google"}
-
-        try:
-            response = requests.get(IAM_TOKEN_ENDPOINT, headers=headers)
-
-        except Exception as e:
-            logging.error("Не удалось выполнить запрос:", e)
-            logging.info("Токен не получен")
-
-        else:
-            if response.status_code == 200:
-                token_data = {
-                    "access_token": response.json().get("access_token"),
-                    "expires_at": response.json().get("expires_in") + time.time(),
-                }
-
-                with open(IAM_TOKEN_PATH, "w") as token_file:
-                    json.dump(token_data, token_file)
-
-            else:
-                logging.error("Ошибка при получении ответа:", response.status_code)
-                logging.info("Токен не получен")
 
 class Monetize(IOP):
+    GPT_RATE = 0.20 / 1000
+    RECOGNITION_RATE = 0.16
+    SYNTHESIS_RATE = 1320 / 1000000
+
     def gpt_rate(self, tokens: int) -> float:
-        return tokens * (0.20 / 1000)
+        return tokens * self.GPT_RATE
 
     def speechkit_recog_rate(self, blocks: int) -> float:
-        return blocks * 0.16
+        return blocks * self.RECOGNITION_RATE
 
     def speechkit_synt_rate(self, symbols: int) -> float:
-        return float(symbols * (1320 / 1000000))
+        return float(symbols * self.SYNTHESIS_RATE)
+
+    def costs(self, idp: int) -> dict[str, float]:
+        """
+        Calculates what a user owes for each technology from one read of their row.
+
+        Args:
+            idp (int): The ID of the user.
+
+        Returns:
+            dict[str, float]: The cost of "gpt", "stt" and "tts" usage and their sum under "all".
+        """
+        user = self.dbc.get_limits(idp)
+        gpt_limit = GPT_LIMIT - int(user["gpt_limit"]) if user.get("gpt_limit") is not None else 0
+        stt_limit = STT_LIMIT - int(user["stt_limit"]) if user.get("stt_limit") is not None else 0
+        tts_limit = TTS_LIMIT - int(user["tts_limit"]) if user.get("tts_limit") is not None else 0
+        costs = {
+            "gpt": self.gpt_rate(gpt_limit),
+            "stt": self.speechkit_recog_rate(stt_limit),
+            "tts": self.speechkit_synt_rate(tts_limit),
+        }
+        costs["all"] = costs["gpt"] + costs["stt"] + costs["tts"]
+        return costs
 
     def cost_calculation(self, idp: int, typed: str) -> float:
-        user = self.db(idp)
-        gpt_limit = GPT_LIMIT - int(user.get("gpt_limit")) if user.get("gpt_limit") else 0
-        stt_limit = STT_LIMIT - int(user.get("stt_limit")) if user.get("stt_limit") else 0
-        tts_limit = TTS_LIMIT - int(user.get("tts_limit")) if user.get("tts_limit") else 0
-        if typed == "gpt":
-            return self.gpt_rate(gpt_limit)
-        elif typed == "stt":
-            return self.speechkit_recog_rate(stt_limit)
-        elif typed == "tts":
-            return self.speechkit_synt_rate(tts_limit)
-        else:
-            Exception("Неверный тип технологии для вычисления стоймости")
-    
+        if typed not in ("gpt", "stt", "tts"):
+            raise ValueError("Неверный тип технологии для вычисления стоймости")
+        return self.costs(idp)[typed]
+
     def update_debts(self):
-        ids = [user[1] for user in self.dbc.get_all_users()]
-        for id in ids:
-            self.dbc.update_value(id, "debt", self.cost_calculation(id, "gpt") + self.cost_calculation(id, "stt") + self.cost_calculation(id, "tts"))
-            logging.info(f"Обновление долга у пользователя {id}")
+        """
+        Recalculates the debt of every user with a single UPDATE.
+        """
+        usage_counter.flush()
+        updated = self.dbc.update_debts(
+            (GPT_LIMIT, self.GPT_RATE),
+            (STT_LIMIT, self.RECOGNITION_RATE),
+            (TTS_LIMIT, self.SYNTHESIS_RATE),
+        )
+        logging.info(f"Обновление долга у {updated} пользователей")
+
+
+class UserCache:
+    """
+    Bounded LRU cache of the rows returned by Database.get_user_data. A row may
+    hold only the columns that have been read so far.
+
+    Entries expire after `ttl` seconds. Database writes are applied to the cached
+    row (write-through), so a hit never returns settings older than the table.
+    """
+
+    def __init__(self, size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[int, tuple[float, dict]] = OrderedDict()
+
+    def get(self, user_id: int) -> dict | None:
+        """
+        Returns a copy of the cached row, or None on a miss or an expired entry.
+        """
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return dict(entry[1])
+
+    def put(self, user_id: int, row: dict):
+        with self.lock:
+            self.entries[user_id] = (time.monotonic() + self.ttl, dict(row))
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def merge(self, user_id: int, columns: dict):
+        """
+        Adds columns read from the database to the cached row, caching them as a new row on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[0] <= time.monotonic():
+                entry = (time.monotonic() + self.ttl, {})
+                self.entries[user_id] = entry
+            entry[1].update(columns)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def update(self, user_id: int, column: str, value):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and column in entry[1]:
+                entry[1][column] = value
+
+    def invalidate(self, user_id: int):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+
+class UsageCounter:
+    """
+    Write-behind buffer of usage counters.
+
+    Charges that are only known after the fact (synthesized symbols, GPT tokens) and
+    the all-time token counter are summed in memory and written every
+    USAGE_FLUSH_INTERVAL seconds and on stop: the limits in one SQLite transaction,
+    the counter in one rewrite of TOKENS_DATA_PATH.
+
+    Each change is first appended to a journal with a sequence number. Both
+    destinations remember the last number they include, so replaying the journal
+    on start restores what a crash left unwritten without counting anything twice.
+    """
+
+    def __init__(self, journal_path: str = USAGE_JOURNAL_PATH):
+        self.journal_path = journal_path
+        self.lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.flusher: threading.Thread | None = None
+        self.database: "Database | None" = None
+        self.journal = None
+        self.seq = 0
+        self.limits: dict[tuple[int, str], int] = {}
+        self.tokens = 0
+
+    def start(self):
+        """
+        Replays the journal and starts the background flusher.
+        """
+        with self.lock:
+            if self.flusher is not None:
+                return
+            self.database = Database()
+            limits_seq = self.database.usage_seq()
+            tokens_seq = self.read_tokens()[1]
+            self.seq = max(limits_seq, tokens_seq)
+            replayed = 0
+            for entry in self.read_journal():
+                self.seq = max(self.seq, entry["seq"])
+                if "tokens" in entry and entry["seq"] > tokens_seq:
+                    self.tokens += entry["tokens"]
+                    replayed += 1
+                elif "column" in entry and entry["seq"] > limits_seq:
+                    key = (entry["user_id"], entry["column"])
+                    self.limits[key] = self.limits.get(key, 0) + entry["amount"]
+                    replayed += 1
+            if replayed:
+                logging.warning(f"Восстановлено записей из журнала: {replayed} (UsageCounter.start)")
+            self.journal = open(self.journal_path, "a")
+            self.flusher = threading.Thread(target=self.run, name="usage-counter", daemon=True)
+            self.flusher.start()
+
+    def stop(self):
+        """
+        Stops the flusher and writes everything that is still pending.
+        """
+        self.stop_event.set()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flush()
+            self.journal.close()
+
+    def run(self):
+        while not self.stop_event.wait(USAGE_FLUSH_INTERVAL):
+            self.flush()
+
+    def read_journal(self) -> list[dict]:
+        entries = []
+        try:
+            with open(self.journal_path, "r") as journal:
+                for line in journal:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # The last line may be cut short by a crash mid-write.
+                        logging.warning("Пропущена поврежденная запись журнала (UsageCounter.read_journal)")
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def record(self, entry: dict):
+        if self.flusher is None:
+            self.start()
+        self.seq += 1
+        entry["seq"] = self.seq
+        self.journal.write(json.dumps(entry) + "\n")
+        self.journal.flush()
+
+    def add(self, user_id: int, column: str, amount: int):
+        """
+        Subtracts an amount from one of the user's limits (see Database.charge) on the next flush.
+        """
+        with self.lock:
+            self.record({"user_id": user_id, "column": column, "amount": amount})
+            key = (user_id, column)
+            self.limits[key] = self.limits.get(key, 0) + amount
+
+    def add_tokens(self, tokens: int):
+        """
+        Adds tokens to the all-time counter in TOKENS_DATA_PATH on the next flush.
+        """
+        with self.lock:
+            self.record({"tokens": tokens})
+            self.tokens += tokens
+
+    def apply(self, user_id: int, row: dict) -> dict:
+        """
+        Subtracts the charges not yet written to the database from a user's row.
+        """
+        if self.flusher is None:
+            self.start()
+        with self.lock:
+            for column in ("tts_limit", "stt_limit", "gpt_limit"):
+                amount = self.limits.get((user_id, column))
+                if amount and column in row:
+                    row[column] -= amount
+        return row
+
+    def read_tokens(self) -> tuple[int, int]:
+        """
+        Returns the all-time token counter and the journal sequence number it includes.
+        """
+        try:
+            with open(TOKENS_DATA_PATH, "r") as token_file:
+                data = json.load(token_file)
+            return data["tokens_count"], data.get("seq", 0)
+        except FileNotFoundError:
+            return 0, 0
+
+    def flush(self):
+        """
+        Writes the pending charges and tokens; the journal is emptied once both are written.
+        """
+        with self.lock:
+            if self.flusher is None or (not self.limits and not self.tokens):
+                return
+            try:
+                if self.limits:
+                    self.database.apply_usage(
+                        [(user_id, column, amount) for (user_id, column), amount in self.limits.items()],
+                        self.seq,
+                    )
+                    self.limits.clear()
+                if self.tokens:
+                    tokens_count = self.read_tokens()[0] + self.tokens
+                    with open(f"{TOKENS_DATA_PATH}.tmp", "w") as token_file:
+                        json.dump({"tokens_count": tokens_count, "seq": self.seq}, token_file)
+                    os.replace(f"{TOKENS_DATA_PATH}.tmp", TOKENS_DATA_PATH)
+                    self.tokens = 0
+            except Exception as e:
+                logging.error(f"Не удалось записать счетчики (UsageCounter.flush): {e}")
+                return
+            self.journal.truncate(0)
+
+
+usage_counter = UsageCounter()
 
 
 class Database:
+    """
+    SQLite access layer.
+
+    Connections are kept open for the lifetime of the thread that created them
+    (one connection per thread, shared by every Database instance), so a query
+    doesn't pay for connect/close and the compiled statement cache survives between calls.
+    """
+
+    COLUMNS = {
+        "tts_limit": int,
+        "stt_limit": int,
+        "gpt_limit": int,
+        "gpt_chat": str,
+        "ban": bool,
+        "voice": str,
+        "emotion": str,
+        "speed": int,
+        "debt": int,
+    }
+    SETTINGS_COLUMNS = ("voice", "emotion", "speed")
+    LIMITS_COLUMNS = ("tts_limit", "stt_limit", "gpt_limit", "debt")
+    USER_COLUMNS = LIMITS_COLUMNS + ("ban",) + SETTINGS_COLUMNS
+
+    cache = UserCache()
+    migrated = False
+    local = threading.local()
+    connections: list[sqlite3.Connection] = []
+    connections_lock = threading.Lock()
+
     def __init__(self):
         self.create_table()
 
-    def executer(self, command: str, data: tuple = None):
-        try:
-            self.connection = sqlite3.connect(DB_PATH)
-            self.cursor = self.connection.cursor()
+    def get_connection(self) -> sqlite3.Connection:
+        """
+        Returns the connection of the current thread, opening it on first use.
+
+        Returns:
+            sqlite3.Connection: The connection bound to the current thread.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                DB_PATH,
+                timeout=DB_TIMEOUT,
+                cached_statements=DB_CACHED_STATEMENTS,
+                check_same_thread=False,
+            )
+            connection.execute("PRAGMA journal_mode=WAL;")
+            connection.execute("PRAGMA synchronous=NORMAL;")
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Runs several statements on the thread's connection as one transaction.
 
-            if data:
-                self.cursor.execute(command, data)
+        Yields:
+            sqlite3.Connection: The connection to execute the statements on.
+        """
+        connection = self.get_connection()
+        with connection:
+            yield connection
 
-            else:
-                self.cursor.execute(command)
+    def execute(self, command: str, data: tuple = None) -> list[tuple]:
+        """
+        Runs a single statement in its own transaction. Unlike `executer`, errors are raised.
+        """
+        connection = self.get_connection()
+        with connection:
+            cursor = connection.execute(command, data) if data else connection.execute(command)
+            return cursor.fetchall()
+
+    def executer(self, command: str, data: tuple = None):
+        try:
+            return self.execute(command, data)
 
         except Exception as e:
             logging.error(f"Ошибка при выполнении запроса (executer): {e}")
+            return []
 
-        self.connection.commit()
-        result = self.cursor.fetchall()
-        self.connection.close()
-        return result
+    @classmethod
+    def close(cls):
+        """
+        Closes every pooled connection. Called once on shutdown.
+        """
+        with cls.connections_lock:
+            for connection in cls.connections:
+                connection.close()
+            cls.connections.clear()
+        cls.local = threading.local()
 
     def create_table(self):
         try:
-            self.executer(
-                f"""CREATE TABLE IF NOT EXISTS {TABLE_NAME}
-                (id INTEGER PRIMARY KEY,
-                user_id INTEGER,
-                tts_limit INTEGER,
-                stt_limit INTEGER,
-                gpt_limit INTEGER,
-                gpt_chat TEXT,
-                ban INTEGER,
-                voice TEXT,
-                emotion TEXT,
-                speed INTEGER,
-                debt INTEGER);
-                """
-            )
-            logging.info(f"Таблица {TABLE_NAME} создана")
+            if not Database.migrated:
+                self.migrate()
+                Database.migrated = True
+                logging.info(f"Таблица {TABLE_NAME} создана")
         except Exception as e:
-            logging.error("Ошибка при создании таблицы: ", e)
+            logging.error(f"Ошибка при создании таблицы: {e}")
             exit(1)
+
+    def migrations(self) -> list:
+        """
+        The schema changes in the order they were introduced.
+
+        A database at version N has the first N of them applied. New changes are
+        appended to the end; released migrations are never edited or reordered.
+        Databases created before versioning start at version 0, so every step
+        must also work on tables that already exist.
+        """
+        return [
+            self.create_texts,
+            self.create_messages,
+            self.create_user_index,
+            self.migrate_chats,
+            self.create_transcripts,
+            self.create_usage_state,
+        ]
+
+    def migrate(self):
+        """
+        Brings the schema up to date, applying the missing migrations in one transaction.
+        """
+        connection = self.get_connection()
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {SCHEMA_TABLE} (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER);"
+        )
+        migrations = self.migrations()
+        with connection:
+            # Taking the write lock first keeps a second process from applying the same steps.
+            connection.execute("BEGIN IMMEDIATE;")
+            result = connection.execute(f"SELECT version FROM {SCHEMA_TABLE} WHERE id=0;").fetchall()
+            version = result[0][0] if result else 0
+            if version > len(migrations):
+                raise RuntimeError(f"Версия схемы {version} новее кода ({len(migrations)})")
+            for number, migration in enumerate(migrations[version:], version + 1):
+                migration(connection)
+                logging.info(f"Применена миграция {number}: {migration.__name__}")
+            connection.execute(
+                f"INSERT INTO {SCHEMA_TABLE} (id, version) VALUES (0, ?) ON CONFLICT(id) DO UPDATE SET version=excluded.version;",
+                (len(migrations),),
+            )
+
+    def create_texts(self, connection: sqlite3.Connection):
+        connection.execute(
+            f"""CREATE TABLE IF NOT EXISTS {TABLE_NAME}
+            (id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            tts_limit INTEGER,
+            stt_limit INTEGER,
+            gpt_limit INTEGER,
+            gpt_chat TEXT,
+            ban INTEGER,
+            voice TEXT,
+            emotion TEXT,
+            speed INTEGER,
+            debt INTEGER);
+            """
+        )
+
+    def create_messages(self, connection: sqlite3.Connection):
+        connection.execute(
+            f"""CREATE TABLE IF NOT EXISTS {MESSAGES_TABLE}
+            (id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            seq INTEGER,
+            role TEXT,
+            content TEXT,
+            token_count INTEGER);
+            """
+        )
+        connection.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {MESSAGES_TABLE}_user_seq ON {MESSAGES_TABLE} (user_id, seq);"
+        )
+
+    def migrate_chats(self, connection: sqlite3.Connection):
+        """
+        Moves chat histories left in the gpt_chat column to the messages table.
+        """
+        chats = connection.execute(
+            f"SELECT user_id, gpt_chat FROM {TABLE_NAME} WHERE gpt_chat NOT IN ('', '[]');"
+        ).fetchall()
+        for user_id, gpt_chat in chats:
+            try:
+                rows = json.loads(gpt_chat)
+            except ValueError:
+                rows = []
+            connection.executemany(
+                f"INSERT INTO {MESSAGES_TABLE} (user_id, seq, role, content, token_count) VALUES (?, ?, ?, ?, ?);",
+                [
+                    (user_id, seq, row["role"], row["content"], row.get("tokens"))
+                    for seq, row in enumerate(rows, 1)
+                    if row.get("content") is not None
+                ],
+            )
+            connection.execute(
+                f"UPDATE {TABLE_NAME} SET gpt_chat='' WHERE user_id=?;", (user_id,)
+            )
+            logging.info(f"История чата пользователя {user_id} перенесена в {MESSAGES_TABLE}")
+
+    def create_user_index(self, connection: sqlite3.Connection):
+        """
+        Creates the unique index on user_id, first deleting duplicate rows of a user
+        (the oldest row is kept) that an earlier racing sign-up may have left.
+        """
+        removed = connection.execute(
+            f"DELETE FROM {TABLE_NAME} WHERE id NOT IN (SELECT MIN(id) FROM {TABLE_NAME} GROUP BY user_id);"
+        ).rowcount
+        connection.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {TABLE_NAME}_user_id ON {TABLE_NAME} (user_id);"
+        )
+        if removed:
+            logging.warning(f"Удалено повторных записей пользователей: {removed}")
+
+    def create_transcripts(self, connection: sqlite3.Connection):
+        connection.execute(
+            f"""CREATE TABLE IF NOT EXISTS {TRANSCRIPTS_TABLE}
+            (file_unique_id TEXT PRIMARY KEY,
+            text TEXT,
+            used_at REAL);
+            """
+        )
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {TRANSCRIPTS_TABLE}_used_at ON {TRANSCRIPTS_TABLE} (used_at);"
+        )
+
+    def create_usage_state(self, connection: sqlite3.Connection):
+        connection.execute(
+            f"""CREATE TABLE IF NOT EXISTS {USAGE_TABLE}
+            (id INTEGER PRIMARY KEY CHECK (id = 0),
+            seq INTEGER);
+            """
+        )
+
     def add_user(self, user_id: int, ban: int):
         """
         Adds a new user to the database.
@@ -647,15 +2260,46 @@ class Database:
             ban (int): The ban status of the user.
         """
         try:
-            self.executer(
-                f"INSERT INTO {TABLE_NAME} (user_id, tts_limit, stt_limit, gpt_limit, ban, voice, emotion, speed, gpt_chat, debt) VALUES ({user_id}, {TTS_LIMIT}, {STT_LIMIT}, {GPT_LIMIT}, {ban}, 'zahar', 'neutral', 1, '', 0);"
-                )
+            self.execute(
+                f"INSERT INTO {TABLE_NAME} (user_id, tts_limit, stt_limit, gpt_limit, ban, voice, emotion, speed, gpt_chat, debt) VALUES (?, ?, ?, ?, ?, 'zahar', 'neutral', 1, '', 0);",
+                (user_id, TTS_LIMIT, STT_LIMIT, GPT_LIMIT, ban),
+            )
+            self.cache.invalidate(user_id)
             logging.info(f"Добавлен пользователь {user_id}")
         except Exception as e:
             logging.error(
                 f"Возникла ошибка при добавлении пользователя {user_id} (DataBase.add_user): {e}"
             )
 
+    def register_user(self, user_id: int, max_users: int) -> bool:
+        """
+        Adds a new user in one statement; the user is banned if the table already
+        holds `max_users` users. Does nothing if the user is already registered.
+
+        Args:
+            user_id (int): The ID of the user.
+            max_users (int): The number of users allowed without a ban.
+
+        Returns:
+            bool: True if the user was added.
+        """
+        try:
+            result = self.execute(
+                f"""INSERT INTO {TABLE_NAME} (user_id, tts_limit, stt_limit, gpt_limit, ban, voice, emotion, speed, gpt_chat, debt)
+                SELECT ?, ?, ?, ?, (SELECT COUNT(*) FROM {TABLE_NAME}) >= ?, 'zahar', 'neutral', 1, '', 0 WHERE true
+                ON CONFLICT(user_id) DO NOTHING RETURNING ban;""",
+                (user_id, TTS_LIMIT, STT_LIMIT, GPT_LIMIT, max_users),
+            )
+            self.cache.invalidate(user_id)
+            if result:
+                logging.info(f"Добавлен пользователь {user_id}{' (бан)' if result[0][0] else ''}")
+            return bool(result)
+        except Exception as e:
+            logging.error(
+                f"Возникла ошибка при добавлении пользователя {user_id} (DataBase.register_user): {e}"
+            )
+            return False
+
     def check_user(self, user_id: int) -> bool:
         """
         Checks if a user exists in the database.
@@ -668,7 +2312,7 @@ class Database:
         """
         try:
             result = self.executer(
-                f"SELECT user_id FROM {TABLE_NAME} WHERE user_id=?;", (user_id,)
+                f"SELECT 1 FROM {TABLE_NAME} WHERE user_id=? LIMIT 1;", (user_id,)
             )
             return bool(result)
         except Exception as e:
@@ -684,33 +2328,109 @@ class Database:
             value: The new value for the column.
         """
         try:
-            self.executer(
+            self.execute(
                 f"UPDATE {TABLE_NAME} SET {column}=? WHERE user_id=?;", (value, user_id)
             )
+            if column in self.COLUMNS:
+                self.cache.update(user_id, column, self.COLUMNS[column](value))
             logging.info(f"Обновлено значение {column} для пользователя {user_id}")
         except Exception as e:
             logging.error(
                 f"Возникла ошибка при обновлении значения {column} для пользователя {user_id}: {e}"
             )
 
-    def get_user_data(self, user_id: int) -> dict:
+    def charge(self, user_id: int, column: str, amount: int, strict: bool = True) -> int | None:
+        """
+        Subtracts an amount from one of the user's limits in a single statement.
+
+        Args:
+            user_id (int): The ID of the user.
+            column (str): "tts_limit", "stt_limit" or "gpt_limit".
+            amount (int): The amount to subtract; a negative amount gives it back.
+            strict (bool): Only subtract if at least `amount` is left.
+
+        Returns:
+            int | None: The remaining limit, or None if the limit is too low (or the
+            user is not registered) and nothing was subtracted.
+        """
+        if column not in ("tts_limit", "stt_limit", "gpt_limit"):
+            raise ValueError(f"Неизвестный лимит {column}")
+        try:
+            result = self.execute(
+                f"UPDATE {TABLE_NAME} SET {column} = {column} - ? WHERE user_id = ?"
+                f"{f' AND {column} >= ?' if strict else ''} RETURNING {column};",
+                (amount, user_id, amount) if strict else (amount, user_id),
+            )
+        except Exception as e:
+            logging.error(f"Возникла ошибка при списании {column} у пользователя {user_id}: {e}")
+            return None
+        if not result:
+            return None
+        self.cache.update(user_id, column, int(result[0][0]))
+        return int(result[0][0])
+
+    def usage_seq(self) -> int:
+        """
+        Returns the last UsageCounter journal sequence number applied to the limits.
+        """
+        result = self.execute(f"SELECT seq FROM {USAGE_TABLE} WHERE id=0;")
+        return result[0][0] if result else 0
+
+    def apply_usage(self, charges: list[tuple[int, str, int]], seq: int):
+        """
+        Subtracts a batch of charges from the users' limits in one transaction.
+
+        Args:
+            charges (list[tuple[int, str, int]]): The user ID, limit column and amount of each charge.
+            seq (int): The last UsageCounter journal sequence number included in the batch.
+        """
+        with self.transaction() as connection:
+            for column in ("tts_limit", "stt_limit", "gpt_limit"):
+                connection.executemany(
+                    f"UPDATE {TABLE_NAME} SET {column} = {column} - ? WHERE user_id = ?;",
+                    [(amount, user_id) for user_id, charged, amount in charges if charged == column],
+                )
+            connection.execute(
+                f"INSERT INTO {USAGE_TABLE} (id, seq) VALUES (0, ?) ON CONFLICT(id) DO UPDATE SET seq=excluded.seq;",
+                (seq,),
+            )
+        for user_id, _, _ in charges:
+            self.cache.invalidate(user_id)
+
+    def get_user_data(self, user_id: int, columns: tuple[str, ...] | None = None) -> dict:
+        """
+        Retrieves the user's row, or only some of its columns.
+
+        The row is served from the cache when it holds every requested column;
+        otherwise only the requested columns are read and added to the cached row.
+
+        Args:
+            user_id (int): The ID of the user.
+            columns (tuple[str, ...]): The columns to read, USER_COLUMNS by default.
+                The legacy gpt_chat blob is only read when asked for.
+
+        Returns:
+            dict: The requested columns, or an empty dict if the user is not registered.
+        """
+        columns = columns or self.USER_COLUMNS
+        # UsageCounter.flush commits the pending charges and invalidates the cache under
+        # the same lock, so a row read before a flush is never combined with the charges
+        # cleared by it.
+        with usage_counter.lock:
+            cached = self.cache.get(user_id)
+            if cached is not None and all(column in cached for column in columns):
+                return usage_counter.apply(user_id, {column: cached[column] for column in columns})
             try:
                 result = self.executer(
-                    f"SELECT * FROM {TABLE_NAME} WHERE user_id=?;", (user_id,)
+                    f"SELECT {', '.join(columns)} FROM {TABLE_NAME} WHERE user_id=?;", (user_id,)
                 )
                 if result:
                     presult = {
-                        "tts_limit": int(result[0][2]),
-                        "stt_limit": int(result[0][3]),
-                        "gpt_limit": int(result[0][4]),
-                        "gpt_chat": str(result[0][5]),
-                        "ban": bool(result[0][6]),
-                        "voice": str(result[0][7]),
-                        "emotion": str(result[0][8]),
-                        "speed": int(result[0][9]),
-                        "debt": int(result[0][10]),
+                        column: self.COLUMNS[column](value)
+                        for column, value in zip(columns, result[0])
                     }
-                    return presult
+                    self.cache.merge(user_id, presult)
+                    return usage_counter.apply(user_id, presult)
                 else:
                     logging.error(f"Пользователь {user_id} не найден в базе данных вернулся пустой словарь")
                     return {}
@@ -720,6 +2440,55 @@ class Database:
                 )
                 return {}
 
+    def get_settings(self, user_id: int) -> dict:
+        """
+        Returns the user's "voice", "emotion" and "speed".
+        """
+        return self.get_user_data(user_id, self.SETTINGS_COLUMNS)
+
+    def get_limits(self, user_id: int) -> dict:
+        """
+        Returns the user's "tts_limit", "stt_limit", "gpt_limit" and "debt".
+        """
+        return self.get_user_data(user_id, self.LIMITS_COLUMNS)
+
+    def is_banned(self, user_id: int) -> bool:
+        return bool(self.get_user_data(user_id, ("ban",)).get("ban"))
+
+    def get_history(self, user_id: int) -> str:
+        """
+        Returns the legacy gpt_chat column (chat history now lives in the messages table, see `get_chat`).
+        """
+        return self.get_user_data(user_id, ("gpt_chat",)).get("gpt_chat", "")
+
+    def update_debts(
+        self, gpt: tuple[int, float], stt: tuple[int, float], tts: tuple[int, float]
+    ) -> int:
+        """
+        Sets the debt of every user to the cost of the limits they have used up, in one statement.
+
+        Args:
+            gpt (tuple[int, float]): The initial gpt_limit and the price of a token.
+            stt (tuple[int, float]): The initial stt_limit and the price of a block.
+            tts (tuple[int, float]): The initial tts_limit and the price of a symbol.
+
+        Returns:
+            int: The number of updated users.
+        """
+        try:
+            result = self.execute(
+                f"""UPDATE {TABLE_NAME} SET debt =
+                COALESCE((? - gpt_limit) * ?, 0) + COALESCE((? - stt_limit) * ?, 0) + COALESCE((? - tts_limit) * ?, 0)
+                RETURNING user_id, debt;""",
+                (*gpt, *stt, *tts),
+            )
+            for user_id, debt in result:
+                self.cache.update(user_id, "debt", self.COLUMNS["debt"](debt))
+            return len(result)
+        except Exception as e:
+            logging.error(f"Возникла ошибка при обновлении долгов: {e}")
+            return 0
+
     def get_all_users(
         self,
     ) -> list[tuple[int, int, int, int, int, str, int, str, str, str]]:
@@ -745,7 +2514,156 @@ class Database:
             user_id (int): The ID of the user.
         """
         try:
-            self.executer(f"DELETE FROM {TABLE_NAME} WHERE user_id=?;", (user_id,))
+            with self.transaction() as connection:
+                connection.execute(f"DELETE FROM {TABLE_NAME} WHERE user_id=?;", (user_id,))
+                connection.execute(f"DELETE FROM {MESSAGES_TABLE} WHERE user_id=?;", (user_id,))
+            self.cache.invalidate(user_id)
             logging.warning(f"Удален пользователь {user_id}")
         except Exception as e:
             logging.error(f"Возникла ошибка при удалении пользователя {user_id}: {e}")
+
+    def get_chat(self, user_id: int, budget: int | None = None) -> list[dict]:
+        """
+        Retrieves the chat history of a user.
+
+        Args:
+            user_id (int): The ID of the user.
+            budget (int): If given, only the newest messages are read, up to and including
+                the first one that makes their token count exceed the budget.
+
+        Returns:
+            list[dict]: The messages in chronological order.
+        """
+        rows = []
+        used = 0
+        try:
+            cursor = self.get_connection().execute(
+                f"SELECT seq, role, content, token_count FROM {MESSAGES_TABLE} WHERE user_id=? ORDER BY seq DESC;",
+                (user_id,),
+            )
+            for seq, role, content, token_count in cursor:
+                rows.append({"role": role, "content": content, "tokens": token_count, "seq": seq})
+                used += token_count if token_count is not None else math.ceil(len(content) / CHARS_PER_TOKEN)
+                if budget is not None and used > budget:
+                    break
+            cursor.close()
+        except Exception as e:
+            logging.error(f"Возникла ошибка при получении истории чата пользователя {user_id}: {e}")
+        rows.reverse()
+        return rows
+
+    def add_messages(self, user_id: int, rows: list[dict]):
+        """
+        Appends messages to the end of the chat history of a user.
+
+        Args:
+            user_id (int): The ID of the user.
+            rows (list[dict]): The messages with "role", "content" and "tokens".
+        """
+        try:
+            with self.transaction() as connection:
+                connection.executemany(
+                    f"""INSERT INTO {MESSAGES_TABLE} (user_id, seq, role, content, token_count)
+                    SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ? FROM {MESSAGES_TABLE} WHERE user_id=?;""",
+                    [(user_id, row["role"], row["content"], row.get("tokens"), user_id) for row in rows],
+                )
+        except Exception as e:
+            logging.error(f"Возникла ошибка при сохранении истории чата пользователя {user_id}: {e}")
+
+    def set_token_counts(self, user_id: int, counts: list[tuple[int, int]]):
+        """
+        Saves the token counts of messages stored without one.
+
+        Args:
+            user_id (int): The ID of the user.
+            counts (list[tuple[int, int]]): The sequence number and token count of each message.
+        """
+        try:
+            with self.transaction() as connection:
+                connection.executemany(
+                    f"UPDATE {MESSAGES_TABLE} SET token_count=? WHERE user_id=? AND seq=?;",
+                    [(tokens, user_id, seq) for seq, tokens in counts],
+                )
+        except Exception as e:
+            logging.error(f"Возникла ошибка при сохранении токенов истории пользователя {user_id}: {e}")
+
+    def replace_messages(self, user_id: int, first_seq: int, last_seq: int, row: dict):
+        """
+        Replaces a run of messages in the chat history of a user with one message.
+
+        Only the given range is replaced; older messages stay where they are.
+
+        Args:
+            user_id (int): The ID of the user.
+            first_seq (int): The first sequence number to replace.
+            last_seq (int): The last sequence number to replace.
+            row (dict): The message to put in place of the replaced ones.
+        """
+        try:
+            with self.transaction() as connection:
+                connection.execute(
+                    f"DELETE FROM {MESSAGES_TABLE} WHERE user_id=? AND seq BETWEEN ? AND ?;",
+                    (user_id, first_seq, last_seq),
+                )
+                connection.execute(
+                    f"INSERT INTO {MESSAGES_TABLE} (user_id, seq, role, content, token_count) VALUES (?, ?, ?, ?, ?);",
+                    (user_id, last_seq, row["role"], row["content"], row.get("tokens")),
+                )
+        except Exception as e:
+            logging.error(f"Возникла ошибка при сокращении истории чата пользователя {user_id}: {e}")
+
+    def clear_chat(self, user_id: int):
+        """
+        Deletes the chat history of a user.
+
+        Args:
+            user_id (int): The ID of the user.
+        """
+        try:
+            self.execute(f"DELETE FROM {MESSAGES_TABLE} WHERE user_id=?;", (user_id,))
+            logging.info(f"Очищена история чата пользователя {user_id}")
+        except Exception as e:
+            logging.error(f"Возникла ошибка при очистке истории чата пользователя {user_id}: {e}")
+
+    def get_transcript(self, file_unique_id: str) -> str | None:
+        """
+        Returns the text recognized earlier from the same voice message.
+
+        Args:
+            file_unique_id (str): The Telegram file_unique_id of the voice.
+
+        Returns:
+            str | None: The text, or None if the voice has not been recognized yet.
+        """
+        try:
+            result = self.execute(
+                f"UPDATE {TRANSCRIPTS_TABLE} SET used_at=? WHERE file_unique_id=? RETURNING text;",
+                (time.time(), file_unique_id),
+            )
+            return result[0][0] if result else None
+        except Exception as e:
+            logging.error(f"Возникла ошибка при получении расшифровки {file_unique_id}: {e}")
+            return None
+
+    def add_transcript(self, file_unique_id: str, text: str):
+        """
+        Saves the text recognized from a voice message, evicting the least recently
+        used transcripts beyond STT_CACHE_SIZE.
+
+        Args:
+            file_unique_id (str): The Telegram file_unique_id of the voice.
+            text (str): The recognized text.
+        """
+        try:
+            with self.transaction() as connection:
+                connection.execute(
+                    f"INSERT OR REPLACE INTO {TRANSCRIPTS_TABLE} (file_unique_id, text, used_at) VALUES (?, ?, ?);",
+                    (file_unique_id, text, time.time()),
+                )
+                connection.execute(
+                    f"""DELETE FROM {TRANSCRIPTS_TABLE} WHERE file_unique_id IN
+                    (SELECT file_unique_id FROM {TRANSCRIPTS_TABLE} ORDER BY used_at DESC LIMIT -1 OFFSET ?);""",
+                    (STT_CACHE_SIZE,),
+                )
+        except Exception as e:
+            logging.error(f"Возникла ошибка при сохранении расшифровки {file_unique_id}: {e}")
@@ -0,0 +1,29 @@
+import os, shutil, sys, tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# iop creates ./data/temp, the TTS cache and the log file on import, so the
+# modules are imported from a scratch working directory with its own data/.
+WORKDIR = tempfile.mkdtemp(prefix="stinu_bot_tests_")
+os.makedirs(os.path.join(WORKDIR, "data"))
+shutil.copy(os.path.join(ROOT, "data", "voices.json"), os.path.join(WORKDIR, "data"))
+os.chdir(WORKDIR)
+
+import iop  # noqa: E402
+
+
+@pytest.fixture
+def database_path(tmp_path, monkeypatch):
+    """
+    Points Database at an empty file and resets its process-wide state.
+    """
+    path = str(tmp_path / "database.db")
+    iop.Database.close()
+    monkeypatch.setattr(iop, "DB_PATH", path)
+    monkeypatch.setattr(iop.Database, "migrated", False)
+    monkeypatch.setattr(iop.Database, "cache", iop.UserCache())
+    yield path
+    iop.Database.close()
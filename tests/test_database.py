@@ -0,0 +1,84 @@
+import json, sqlite3
+
+import iop
+
+
+def baseline_table(path: str, rows: list[tuple]):
+    connection = sqlite3.connect(path)
+    connection.execute(
+        """CREATE TABLE texts
+        (id INTEGER PRIMARY KEY, user_id INTEGER, tts_limit INTEGER, stt_limit INTEGER,
+        gpt_limit INTEGER, gpt_chat TEXT, ban INTEGER, voice TEXT, emotion TEXT,
+        speed INTEGER, debt INTEGER);"""
+    )
+    connection.executemany(
+        "INSERT INTO texts (user_id, tts_limit, stt_limit, gpt_limit, gpt_chat, ban, voice, emotion, speed, debt) "
+        "VALUES (?, 500, 500, 1000, ?, 0, 'zahar', 'neutral', 1, 0);",
+        rows,
+    )
+    connection.commit()
+    connection.close()
+
+
+def test_migrate_baseline_with_duplicate_users(database_path):
+    chat = json.dumps(
+        [{"role": "user", "content": "привет"}, {"role": "assistant", "content": "здравствуй"}]
+    )
+    # Baseline update_value wrote every row of a user, so duplicates share one chat blob.
+    baseline_table(database_path, [(7, chat), (7, chat), (8, "")])
+
+    database = iop.Database()
+
+    assert database.execute("SELECT version FROM schema_version;") == [
+        (len(database.migrations()),)
+    ]
+    assert database.execute("SELECT user_id FROM texts ORDER BY user_id;") == [(7,), (8,)]
+    assert [row["content"] for row in database.get_chat(7)] == ["привет", "здравствуй"]
+    assert database.execute("SELECT gpt_chat FROM texts WHERE user_id=7;") == [("",)]
+    indexes = {row[0] for row in database.execute("SELECT name FROM sqlite_master WHERE type='index';")}
+    assert {"texts_user_id", "messages_user_seq"} <= indexes
+
+
+def test_migrate_is_applied_once(database_path):
+    database = iop.Database()
+    database.register_user(1, 2)
+
+    iop.Database.migrated = False
+    iop.Database()
+
+    assert database.execute("SELECT version FROM schema_version;") == [
+        (len(database.migrations()),)
+    ]
+    assert database.check_user(1)
+
+
+def test_replace_messages_keeps_unsummarized_history(database_path):
+    database = iop.Database()
+    database.add_messages(
+        1, [{"role": "user", "content": f"сообщение {i}", "tokens": 10} for i in range(1, 11)]
+    )
+
+    database.replace_messages(1, 6, 8, {"role": "system", "content": "итог", "tokens": 5})
+
+    assert [(row["seq"], row["content"]) for row in database.get_chat(1)] == [
+        (1, "сообщение 1"), (2, "сообщение 2"), (3, "сообщение 3"),
+        (4, "сообщение 4"), (5, "сообщение 5"), (8, "итог"),
+        (9, "сообщение 9"), (10, "сообщение 10"),
+    ]
+
+
+def test_stored_messages_are_tokenized_once(database_path, monkeypatch):
+    database = iop.Database()
+    database.add_messages(
+        7,
+        [{"role": "user", "content": "привет"}, {"role": "assistant", "content": "здравствуй", "tokens": 4}],
+    )
+    gpt = iop.GPT()
+    calls = []
+    monkeypatch.setattr(gpt, "tokenize_messages", lambda rows: calls.append(rows) or 3)
+
+    gpt.count_stored_tokens(7, database.get_chat(7) + [{"role": "user", "content": "как дела?"}])
+    gpt.count_stored_tokens(7, database.get_chat(7))
+
+    assert [[row["content"] for row in rows] for rows in calls] == [["привет"]]
+    assert [row["tokens"] for row in database.get_chat(7)] == [3, 4]
@@ -0,0 +1,112 @@
+import asyncio, io, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import aiop, iop
+
+OggOpus = iop.OggOpus
+SERIAL = b"\x01\x02\x03\x04"
+PRE_SKIP = 312
+SECOND = OggOpus.SAMPLE_RATE
+
+
+def page(body: bytes, granule: int, type: int = 0, lacing: bytes | None = None) -> dict:
+    return {
+        "type": type,
+        "granule": granule,
+        "serial": SERIAL,
+        "lacing": lacing if lacing is not None else bytes([len(body)]),
+        "body": body,
+    }
+
+
+def voice(pages: list[dict]) -> bytes:
+    head = b"OpusHead\x01\x01" + PRE_SKIP.to_bytes(2, "little") + (48000).to_bytes(4, "little") + bytes(3)
+    headers = [page(head, 0, 0x02), page(b"OpusTags" + bytes(8), 0)]
+    return b"".join(OggOpus.page(p, sequence, p["type"], p["granule"]) for sequence, p in enumerate(headers + pages))
+
+
+def raw_pages(data: bytes) -> list[bytes]:
+    pages, offset = [], 0
+    while offset < len(data):
+        size = 27 + data[offset + 26] + sum(data[offset + 27 : offset + 27 + data[offset + 26]])
+        pages.append(data[offset : offset + size])
+        offset += size
+    return pages
+
+
+def audio_pages() -> list[dict]:
+    """
+    Ten one-second pages; the packet of the sixth page continues into the seventh.
+    """
+    pages = [page(bytes([i]) * 10, PRE_SKIP + i * SECOND) for i in range(1, 11)]
+    pages[5] = page(bytes([6]) * 255, OggOpus.NO_GRANULE, lacing=b"\xff")
+    pages[6] = page(bytes([7]) * 10, PRE_SKIP + 7 * SECOND, OggOpus.CONTINUED)
+    return pages
+
+
+def test_crc_check_value():
+    assert OggOpus.crc(b"123456789") == 0x89A1897F
+
+
+def test_split_multi_page_stream():
+    segments = OggOpus.split(voice(audio_pages()), 3)
+
+    # The continued packet keeps pages 6 and 7 in one segment.
+    assert [[p["body"][0] for p in list(OggOpus.pages(io.BytesIO(s)))[2:]] for s in segments] == [
+        [1, 2, 3],
+        [4, 5, 6, 7],
+        [8, 9, 10],
+    ]
+    for k, segment in enumerate(segments):
+        raw = raw_pages(segment)
+        for sequence, data in enumerate(raw):
+            assert data[:4] == b"OggS"
+            assert int.from_bytes(data[18:22], "little") == sequence
+            assert int.from_bytes(data[22:26], "little") == OggOpus.crc(data[:22] + bytes(4) + data[26:])
+        pages = list(OggOpus.pages(io.BytesIO(segment)))
+        assert pages[0]["body"][:8] == b"OpusHead"
+        assert [p["granule"] for p in pages[:2]] == [0, 0]
+        assert [bool(p["type"] & OggOpus.LAST) for p in pages] == [False] * (len(pages) - 1) + [True]
+        assert pages[2]["granule"] == PRE_SKIP + SECOND
+        if k == 1:
+            assert pages[4]["granule"] == OggOpus.NO_GRANULE
+            assert pages[5]["type"] & OggOpus.CONTINUED
+
+
+def test_split_returns_unparsable_or_short_data_whole():
+    assert OggOpus.split(b"garbage", 3) == [b"garbage"]
+    data = voice(audio_pages()[:2])
+    assert OggOpus.split(data, 3) == [data]
+
+
+def test_long_speech_to_text_stops_on_a_cut_off_stream(monkeypatch):
+    monkeypatch.setattr(iop, "STT_SEGMENT_DURATION", 3)
+    release, calls = threading.Event(), []
+
+    def speech_to_text(segment: bytes, id: str):
+        calls.append(segment)
+        release.wait(5)
+        return True, "текст"
+
+    speechkit = iop.SpeechKit.__new__(iop.SpeechKit)
+    speechkit.stt_pool = ThreadPoolExecutor(max_workers=1)
+    speechkit.speech_to_text = speech_to_text
+    # Two segments are read before the cut-off last page.
+    status, _ = speechkit.long_speech_to_text(voice(audio_pages())[:-5], "1")
+    release.set()
+    speechkit.stt_pool.shutdown(wait=True)
+
+    assert status is False
+    assert len(calls) == 1
+
+
+def test_async_long_speech_to_text_stops_on_a_cut_off_stream(monkeypatch):
+    monkeypatch.setattr(aiop, "STT_SEGMENT_DURATION", 3)
+    speechkit = aiop.AsyncSpeechKit.__new__(aiop.AsyncSpeechKit)
+
+    async def speech_to_text(segment: bytes, id: str):
+        raise AssertionError("a segment of a broken voice was sent")
+
+    speechkit.speech_to_text = speech_to_text
+    status, _ = asyncio.run(speechkit.long_speech_to_text(voice(audio_pages())[:-5], "1"))
+    assert status is False
@@ -0,0 +1,54 @@
+import types
+
+import iop
+
+SpeechPipeline = iop.SpeechPipeline
+
+
+class FakeSpeechKit:
+    audio_file = staticmethod(iop.SpeechKit.audio_file)
+
+    def __init__(self):
+        self.synthesized = []
+
+    def synthesize(self, text: str, id: int):
+        self.synthesized.append(text)
+        return True, b"", "test", True
+
+
+class FakeBot:
+    def send_chat_action(self, chat_id: int, action: str):
+        pass
+
+    def send_audio(self, chat_id: int, audio, **kwargs):
+        return types.SimpleNamespace(audio=None)
+
+
+def test_split_keeps_short_fragments():
+    assert SpeechPipeline.split("1. Пункт") == ["1. Пункт"]
+    assert SpeechPipeline.split("Да. Нет.") == ["Да. Нет."]
+    assert SpeechPipeline.split("Ок") == ["Ок"]
+    chunks = SpeechPipeline.split("а" * 242 + " конец. Да")
+    assert chunks == ["а" * 242 + " конец. Да"]
+
+
+def test_split_cuts_long_sentences():
+    chunks = SpeechPipeline.split(" ".join(["слово"] * 100) + ". 1. Конец.")
+    assert all(len(chunk) <= iop.TTS_CHUNK_LENGTH for chunk in chunks)
+    assert chunks[-1].endswith("слово. 1. Конец.")
+
+
+def test_update_waits_for_a_voiceable_first_sentence():
+    pipeline = SpeechPipeline(None, FakeSpeechKit(), 1, 1)
+    pipeline.update("1. ")
+    assert pipeline.offset == 0 and not pipeline.pending
+    pipeline.update("1. Пункт. Дальше")
+    assert [chunk for chunk, _ in pipeline.pending] == ["1. Пункт."]
+
+
+def test_finish_voices_a_short_tail():
+    speechkit = FakeSpeechKit()
+    pipeline = SpeechPipeline(FakeBot(), speechkit, 1, 1)
+    pipeline.update("1. Пункт. Ок")
+    assert pipeline.finish("1. Пункт. Ок") is True
+    assert speechkit.synthesized == ["1. Пункт.", "Ок"]
@@ -0,0 +1,111 @@
+import json, os, threading
+
+import pytest
+
+import iop
+
+
+@pytest.fixture
+def counter(database_path, tmp_path, monkeypatch):
+    """
+    Returns a factory of UsageCounters sharing one journal; the newest one is iop.usage_counter.
+    """
+    monkeypatch.setattr(iop, "TOKENS_DATA_PATH", str(tmp_path / "tokens.json"))
+    monkeypatch.setattr(iop, "USAGE_FLUSH_INTERVAL", 3600)
+    iop.Database().add_user(1, 0)
+    counters = []
+
+    def make() -> iop.UsageCounter:
+        counters.append(iop.UsageCounter(str(tmp_path / "journal.jsonl")))
+        monkeypatch.setattr(iop, "usage_counter", counters[-1])
+        counters[-1].start()
+        return counters[-1]
+
+    yield make
+    for usage in counters:
+        crash(usage)
+
+
+def crash(usage: iop.UsageCounter):
+    """
+    Stops the flusher without writing what is pending, as a killed process would.
+    """
+    usage.stop_event.set()
+    usage.flusher.join()
+    usage.journal.close()
+
+
+def gpt_limit() -> int:
+    return iop.Database().execute("SELECT gpt_limit FROM texts WHERE user_id=1;")[0][0]
+
+
+def tokens() -> int:
+    with open(iop.TOKENS_DATA_PATH) as token_file:
+        return json.load(token_file)["tokens_count"]
+
+
+def test_replay_after_crash_before_flush(counter):
+    usage = counter()
+    usage.add(1, "gpt_limit", 100)
+    usage.add_tokens(100)
+    crash(usage)
+
+    usage = counter()
+    assert iop.Database().get_limits(1)["gpt_limit"] == 900
+    usage.flush()
+    assert gpt_limit() == 900 and tokens() == 100
+    assert os.path.getsize(usage.journal_path) == 0
+
+
+def test_replay_after_failed_tokens_write(counter, tmp_path, monkeypatch):
+    path = iop.TOKENS_DATA_PATH
+    usage = counter()
+    usage.add(1, "gpt_limit", 100)
+    usage.add_tokens(100)
+    monkeypatch.setattr(iop, "TOKENS_DATA_PATH", str(tmp_path / "missing" / "tokens.json"))
+    usage.flush()
+    assert gpt_limit() == 900
+    crash(usage)
+
+    monkeypatch.setattr(iop, "TOKENS_DATA_PATH", path)
+    usage = counter()
+    usage.flush()
+    assert gpt_limit() == 900 and tokens() == 100
+
+
+def test_restart_after_flush_before_journal_truncate(counter, monkeypatch):
+    usage = counter()
+    usage.add(1, "gpt_limit", 100)
+    usage.add_tokens(100)
+    monkeypatch.setattr(usage.journal, "truncate", lambda size: None)
+    usage.flush()
+    with open(usage.journal_path, "a") as journal:
+        journal.write('{"user_id": 1, "col')
+    crash(usage)
+
+    usage = counter()
+    assert not usage.limits and not usage.tokens
+    usage.add(1, "gpt_limit", 50)
+    usage.flush()
+    assert gpt_limit() == 850 and tokens() == 100
+
+
+def test_flush_during_cache_miss(counter):
+    usage = counter()
+    usage.add(1, "gpt_limit", 100)
+    database = iop.Database()
+    executer = database.executer
+    flusher = threading.Thread(target=usage.flush)
+
+    def select_racing_flush(*args):
+        result = executer(*args)
+        # Without the lock the flush commits and invalidates the cache right here.
+        flusher.start()
+        flusher.join(0.5)
+        return result
+
+    database.executer = select_racing_flush
+    assert database.get_limits(1)["gpt_limit"] == 900
+    flusher.join()
+    assert gpt_limit() == 900
+    assert iop.Database().get_limits(1)["gpt_limit"] == 900